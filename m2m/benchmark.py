@@ -0,0 +1,191 @@
+"""Benchmark the m2m conversion pipeline on synthetic data.
+
+Generates a CSV shaped like tests/data/test.csv, with a configurable
+number of rows and extra fields, plus a matching processRecord mapping.
+It then times each pipeline stage separately:
+
+    parse      reading rows with iterCSVToDict
+    map        running processRecord (record building and mapping())
+    serialize  bytes(record)
+    write      writeTemplateFiles through an OutputWriter
+
+Results are printed and can be saved as JSON to compare across versions:
+
+    $ python -m m2m.benchmark --rows 10000 --fields 5 --output bench.json
+"""
+import os
+import csv
+import sys
+import json
+import time
+import platform
+import tempfile
+from argparse import ArgumentParser
+
+from m2m import m2m
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+MAPPING_HEADER = '''def processRecord(RecordClass, row):
+
+    record = RecordClass('mphillips')
+
+    record.mapping('basic', 'title', row['title'],
+                   qualifier='officialtitle')
+
+    record.mapping('agent', 'creator', row['author'],
+                   qualifier='aut', agent_type='per', info='born somewhere')
+
+    record.mapping('basic', 'date', row['date'],
+                   qualifier='creation', required=False)
+'''
+
+MAPPING_FIELD = '''
+    record.mapping('basic', 'subject', row['subject%d'],
+                   qualifier='KWD', required=False, split=';')
+'''
+
+MAPPING_FOOTER = '''
+    record.setBaseDirectory(%r)
+    record.setFolderName(row['isbn'])
+
+    return record
+'''
+
+
+def writeSyntheticCSV(path, rows, fields):
+    """Write a CSV with the columns of tests/data/test.csv plus extra subjects."""
+    header = ['title', 'author', 'date', 'isbn'] + ['subject%d' % n for n in range(fields)]
+    with open(path, 'w', newline='') as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(header)
+        for n in range(rows):
+            writer.writerow(['Title of book %d' % n,
+                             'Author %d, Some' % (n % 500),
+                             str(1900 + n % 120),
+                             '978%010d' % n] +
+                            ['Topic %d; Topic %d' % (n % 50, f) for f in range(fields)])
+
+
+def writeSyntheticMapping(path, fields, baseDirectory):
+    """Write a processRecord mapping for a synthetic CSV."""
+    with open(path, 'w') as mappingFile:
+        mappingFile.write(MAPPING_HEADER)
+        for n in range(fields):
+            mappingFile.write(MAPPING_FIELD % n)
+        mappingFile.write(MAPPING_FOOTER % baseDirectory)
+
+
+def peakRSS():
+    """Return the peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+def packageVersion():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+    try:
+        return version('m2m')
+    except PackageNotFoundError:
+        return None
+
+
+def runBenchmark(rows=1000, fields=5, workDirectory=None, write=True):
+    """Run the pipeline over synthetic data and return the results dict."""
+    with tempfile.TemporaryDirectory(dir=workDirectory) as tmp:
+        csvPath = os.path.join(tmp, 'bench.csv')
+        mappingPath = os.path.join(tmp, 'bench_untl.py')
+        writeSyntheticCSV(csvPath, rows, fields)
+        writeSyntheticMapping(mappingPath, fields, os.path.join(tmp, 'records'))
+
+        mappingFunction = m2m.loadMappingFunction(mappingPath)
+        writer = m2m.OutputWriter()
+        stages = {'parse': 0.0, 'map': 0.0, 'serialize': 0.0, 'write': 0.0}
+        clock = time.perf_counter
+        count = 0
+
+        started = clock()
+        rowIterator = m2m.iterCSVToDict(csvPath)
+        while True:
+            t0 = clock()
+            row = next(rowIterator, None)
+            t1 = clock()
+            stages['parse'] += t1 - t0
+            if row is None:
+                break
+            record = mappingFunction(m2m.MetadataRecord, row)
+            t2 = clock()
+            data = bytes(record)
+            t3 = clock()
+            if write:
+                writer.writeFile(record.baseDirectory, record.foldername,
+                                 'metadata.xml', data)
+            t4 = clock()
+            stages['map'] += t2 - t1
+            stages['serialize'] += t3 - t2
+            stages['write'] += t4 - t3
+            count += 1
+        writer.close()
+        total = clock() - started
+
+    return {
+        'm2mVersion': packageVersion(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'rows': count,
+        'fields': fields,
+        'seconds': total,
+        'rowsPerSecond': count / total if total else None,
+        'stageSeconds': stages,
+        'peakRSSBytes': peakRSS(),
+    }
+
+
+def formatResults(results):
+    lines = ['%(rows)s rows with %(fields)s extra fields in %(seconds).3fs '
+             '(%(rowsPerSecond).1f rows/sec)' % results]
+    for stage, seconds in results['stageSeconds'].items():
+        share = 100.0 * seconds / results['seconds'] if results['seconds'] else 0
+        lines.append('  %-10s %8.3fs %5.1f%%' % (stage, seconds, share))
+    if results['peakRSSBytes'] is not None:
+        lines.append('  peak RSS   %8.1f MB' % (results['peakRSSBytes'] / 1048576.0))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark the m2m conversion pipeline.')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='Number of synthetic CSV rows')
+    parser.add_argument('--fields', type=int, default=5,
+                        help='Number of extra subject fields per row')
+    parser.add_argument('--no-write', action='store_false', dest='write',
+                        help='Skip writing metadata.xml files')
+    parser.add_argument('--workdir',
+                        help='Directory for temporary benchmark files')
+    parser.add_argument('-o', '--output',
+                        help='Save the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    results = runBenchmark(rows=args.rows, fields=args.fields,
+                           workDirectory=args.workdir, write=args.write)
+    print(formatResults(results))
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=4, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,57 @@
 import csv
+import hashlib
+import functools
 import time
 import os
 import sys
+import io
 import json
-from argparse import ArgumentParser
+import locale
+import contextlib
+import threading
+import queue
+from array import array
+from types import CodeType
+from argparse import ArgumentParser, ArgumentTypeError
+from itertools import islice
+from collections import OrderedDict, deque
 
-from pyuntl.untl_structure import PYUNTL_DISPATCH
-from pyuntl.untldoc import untlpydict2xmlstring, untlpy2dict
+# lxml, pyuntl and the optional columnar modules take a while to import,
+# so they are only imported once they are needed; see loadUNTL and
+# loadColumnarModules.  The same goes for modules only some options use.
+Element = SubElement = tostring = None
+UNTL_XML_ORDER = PYUNTL_DISPATCH = None
+pyarrow = numpy = None
+_columnarModulesLoaded = False
+
+
+def loadUNTL():
+    """Import lxml and pyuntl the first time a record needs them."""
+    global Element, SubElement, tostring, UNTL_XML_ORDER, PYUNTL_DISPATCH
+    if PYUNTL_DISPATCH is None:
+        from lxml.etree import Element, SubElement, tostring
+        from pyuntl import UNTL_XML_ORDER
+        from pyuntl.untl_structure import PYUNTL_DISPATCH
+
+
+def loadColumnarModules():
+    """Import pyarrow and numpy for the columnar backends, if installed."""
+    global pyarrow, numpy, _columnarModulesLoaded
+    if _columnarModulesLoaded:
+        return
+    _columnarModulesLoaded = True
+    try:
+        import pyarrow
+        import pyarrow.compute
+    except ImportError:
+        pyarrow = None
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8"?>\n'
 
 
 fieldTypes = {
@@ -36,8 +81,330 @@ fieldTypes = {
 
 
 def CSVToDict(csvFileName):
-    readerDict = csv.DictReader(open(csvFileName))
-    return list(readerDict)
+    return list(iterCSVToDict(csvFileName))
+
+
+def iterCSVToDict(csvFileName, start=1, progress=None, dialect='excel'):
+    """Yield the rows of a CSV file as dicts, one at a time.
+
+    Rows before the 1-based ``start`` row are skipped without being
+    turned into dicts.  If a ProgressReporter is given, it counts the
+    characters read.  The file is opened with universal newlines, so line
+    breaks in quoted cells are plain newlines even in CRLF files.
+    """
+    with open(csvFileName) as csvFile:
+        lines = csvFile if progress is None else progress.countLines(csvFile)
+        readerDict = csv.DictReader(lines, dialect=dialect)
+        # Reading fieldnames consumes the header before skipping ahead.
+        if readerDict.fieldnames is None:
+            return
+        skipped = 0
+        while skipped < start - 1:
+            try:
+                values = next(readerDict.reader)
+            except StopIteration:
+                return
+            # DictReader ignores blank lines, so they don't count as rows.
+            if values:
+                skipped += 1
+        for row in readerDict:
+            yield row
+
+
+def iterTSVToDict(fileName, start=1, progress=None):
+    """Yield the rows of a tab separated file as dicts, one at a time."""
+    return iterCSVToDict(fileName, start=start, progress=progress, dialect='excel-tab')
+
+
+def textValue(value):
+    """Return a JSON value as the string a CSV cell would hold."""
+    if isinstance(value, str):
+        return value
+    if value is None:
+        return ''
+    return json.dumps(value, ensure_ascii=False)
+
+
+def iterJSONLinesToDict(fileName, start=1, progress=None):
+    """Yield the objects of a JSON lines file as row dicts, one at a time.
+
+    Values that aren't strings are turned into their JSON text, and null
+    into an empty string.  Blank lines are skipped, and lines before the
+    1-based start row aren't parsed.
+    """
+    with open(fileName, encoding='utf-8') as jsonFile:
+        lines = jsonFile if progress is None else progress.countLines(jsonFile)
+        rowNumber = 0
+        for lineNumber, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            rowNumber += 1
+            if rowNumber < start:
+                continue
+            try:
+                values = json.loads(line)
+            except ValueError as e:
+                raise MetadataConverterException(
+                    'Line %s of %s is not valid JSON: %s' % (lineNumber, fileName, e))
+            if not isinstance(values, dict):
+                raise MetadataConverterException(
+                    'Line %s of %s is not a JSON object' % (lineNumber, fileName))
+            yield {key: textValue(value) for key, value in values.items()}
+
+
+def iterSQLiteToDict(fileName, start=1, progress=None, query=None):
+    """Yield the rows of a query on a SQLite database as dicts, one at a time.
+
+    The database is opened read only, and rows are stepped through on
+    the cursor as they are needed rather than fetched all at once.
+    Without a query, the database must have exactly one table, whose
+    rows are read.  Values are turned into strings, and NULL into an
+    empty string.
+    """
+    import sqlite3
+    from urllib.parse import quote
+    if not os.path.isfile(fileName):
+        raise MetadataConverterException('SQLite database %s does not exist' % fileName)
+    connection = sqlite3.connect('file:%s?mode=ro' % quote(os.path.abspath(fileName)),
+                                 uri=True)
+    try:
+        if query is None:
+            tables = [name for name, in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+            if len(tables) != 1:
+                raise MetadataConverterException(
+                    '%s has %s tables, pick the rows to read with --query'
+                    % (fileName, len(tables)))
+            query = 'SELECT * FROM "%s"' % tables[0].replace('"', '""')
+        cursor = connection.execute(query)
+        names = [column[0] for column in cursor.description or ()]
+        for values in islice(cursor, start - 1, None):
+            yield dict(zip(names, ('' if value is None else str(value) for value in values)))
+    finally:
+        connection.close()
+
+
+# Row readers by name, and the file extensions each one is picked for.
+READERS = OrderedDict()
+READER_EXTENSIONS = {}
+
+
+def registerReader(name, reader, extensions=()):
+    """Add a row reader for --reader and for files with these extensions.
+
+    A reader is called as reader(path, start=1, progress=None, **options)
+    and yields one dict per row, skipping the rows before the 1-based
+    start row, so mappings get the same kind of rows from every reader.
+    """
+    READERS[name] = reader
+    for extension in extensions:
+        READER_EXTENSIONS[extension.lower()] = name
+
+
+registerReader('csv', iterCSVToDict, ['.csv'])
+registerReader('tsv', iterTSVToDict, ['.tsv', '.tab'])
+registerReader('jsonl', iterJSONLinesToDict, ['.jsonl', '.ndjson'])
+registerReader('sqlite', iterSQLiteToDict, ['.sqlite', '.sqlite3', '.db'])
+
+
+def readerName(fileName, reader=None):
+    """Return the reader for a file: reader if given, else by extension, else csv."""
+    if reader is not None:
+        return reader
+    return READER_EXTENSIONS.get(os.path.splitext(fileName)[1].lower(), 'csv')
+
+
+def readRows(fileName, reader=None, start=1, progress=None, **options):
+    """Yield the rows of any input file as dicts, with the reader picked by readerName."""
+    return READERS[readerName(fileName, reader)](fileName, start=start, progress=progress,
+                                                 **options)
+
+
+def iterCSVShard(csvFileName, shard, shards, progress=None):
+    """Yield (rowNumber, row) pairs for one shard of a CSV file.
+
+    Row n belongs to shard n % shards + 1, so shards 1 to shards
+    together cover every row exactly once.  Rows of other shards are
+    skipped without being turned into dicts.
+    """
+    with open(csvFileName) as csvFile:
+        lines = csvFile if progress is None else progress.countLines(csvFile)
+        readerDict = csv.DictReader(lines)
+        if readerDict.fieldnames is None:
+            return
+        rowNumber = 0
+        while True:
+            try:
+                if rowNumber % shards == shard - 1:
+                    yield rowNumber, next(readerDict)
+                    rowNumber += 1
+                # DictReader ignores blank lines, so they don't count as rows.
+                elif next(readerDict.reader):
+                    rowNumber += 1
+            except StopIteration:
+                return
+
+
+def countCSVRows(csvFileName):
+    """Return the number of rows in a CSV file, as iterCSVToDict counts them."""
+    with open(csvFileName) as csvFile:
+        reader = csv.reader(csvFile)
+        if next(reader, None) is None:
+            return 0
+        return sum(1 for values in reader if values)
+
+
+class CSVIndex(object):
+    """Byte offsets of the rows of a CSV file, for reading any row directly.
+
+    The offsets are saved to indexPath, if one is given, and reused as
+    long as the CSV's size and modification time are unchanged, so
+    looking up a row only reads the header, one index entry and the row
+    itself.  Rows are numbered from 1 as for --row.
+    """
+
+    version = 1
+    # version, CSV size, CSV mtime and row count come before the offsets.
+    headerSize = 4
+
+    def __init__(self, csvPath, indexPath=None):
+        self.csvPath = csvPath
+        self.indexPath = indexPath
+        self.encoding = locale.getpreferredencoding(False)
+        self.fieldnames = None
+        self.offsets = None
+        self.rowCount = None
+        stat = os.stat(csvPath)
+        self.stamp = [self.version, stat.st_size, stat.st_mtime_ns]
+        if indexPath is not None and os.path.exists(indexPath):
+            header = array('q')
+            with open(indexPath, 'rb') as indexFile:
+                header.frombytes(indexFile.read(header.itemsize * self.headerSize))
+            if len(header) == self.headerSize and list(header[:3]) == self.stamp:
+                self.rowCount = header[3]
+        if self.rowCount is None:
+            self.build()
+
+    def refresh(self):
+        """Rebuild the index if the CSV file has changed since it was built."""
+        stat = os.stat(self.csvPath)
+        stamp = [self.version, stat.st_size, stat.st_mtime_ns]
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self.fieldnames = None
+            self.build()
+
+    def decode(self, line):
+        # Translate line endings as iterCSVToDict's universal newlines do.
+        return line.decode(self.encoding).replace('\r\n', '\n').replace('\r', '\n')
+
+    def lines(self, csvFile):
+        for line in csvFile:
+            yield self.decode(line)
+
+    def build(self):
+        """Find the offset of every row, and save them if there is an indexPath."""
+        offsets = array('q')
+        position = 0
+
+        def countedLines(csvFile):
+            nonlocal position
+            for line in csvFile:
+                position += len(line)
+                yield self.decode(line)
+
+        with open(self.csvPath, 'rb') as csvFile:
+            reader = csv.reader(countedLines(csvFile))
+            # csv.reader reads no further than the end of each record.
+            if next(reader, None) is not None:
+                start = position
+                for values in reader:
+                    # Blank lines are skipped, as in iterCSVToDict.
+                    if values:
+                        offsets.append(start)
+                    start = position
+        self.offsets = offsets
+        self.rowCount = len(offsets)
+        if self.indexPath is not None:
+            tempPath = '%s.%s.tmp' % (self.indexPath, os.getpid())
+            with open(tempPath, 'wb') as indexFile:
+                array('q', self.stamp + [self.rowCount]).tofile(indexFile)
+                offsets.tofile(indexFile)
+            os.replace(tempPath, self.indexPath)
+
+    def rowOffset(self, rowNumber):
+        if not 1 <= rowNumber <= self.rowCount:
+            return None
+        if self.offsets is not None:
+            return self.offsets[rowNumber - 1]
+        offset = array('q')
+        with open(self.indexPath, 'rb') as indexFile:
+            indexFile.seek(offset.itemsize * (self.headerSize + rowNumber - 1))
+            offset.frombytes(indexFile.read(offset.itemsize))
+        return offset[0]
+
+    def row(self, rowNumber):
+        """Return a row as a dict, like iterCSVToDict, or None if there is no such row."""
+        offset = self.rowOffset(rowNumber)
+        if offset is None:
+            return None
+        with open(self.csvPath, 'rb') as csvFile:
+            if self.fieldnames is None:
+                self.fieldnames = next(csv.reader(self.lines(csvFile)))
+            csvFile.seek(offset)
+            return next(csv.DictReader(self.lines(csvFile), self.fieldnames))
+
+
+def serializeUNTL(rootElement):
+    """Serialize a pyuntl metadata tree straight to UNTL XML bytes.
+
+    The output is byte-identical to
+    untlpydict2xmlstring(untlpy2dict(rootElement)) but skips building
+    the intermediate dictionary.
+    """
+    return serializeElements(
+        (element.tag, element.qualifier, element.content,
+         [(child.tag, child.content) for child in element.children])
+        for element in rootElement.children)
+
+
+def serializeElements(elements):
+    """Serialize (tag, qualifier, content, children) tuples to UNTL XML bytes.
+
+    children is a sequence of (tag, content) pairs, and the tuples are
+    treated like the pyuntl elements they describe in serializeUNTL.
+    """
+    loadUNTL()
+    elementsByTag = {}
+    for element in elements:
+        elementsByTag.setdefault(element[0], []).append(element)
+
+    root = Element('metadata')
+    for tag in UNTL_XML_ORDER:
+        for _, qualifier, content, children in elementsByTag.get(tag, ()):
+            # Mirror untlpy2dict: children win over text content, and
+            # elements without any content are dropped.
+            if children:
+                content = {}
+                for childTag, childContent in children:
+                    if childContent is not None:
+                        content[childTag] = childContent
+            elif content is None or content.strip() == '':
+                continue
+            if not content:
+                continue
+
+            if qualifier is not None:
+                subelement = SubElement(root, tag, {'qualifier': qualifier})
+            else:
+                subelement = SubElement(root, tag)
+            if isinstance(content, dict):
+                for childTag, childContent in content.items():
+                    SubElement(subelement, childTag).text = childContent
+            else:
+                subelement.text = content
+    return XML_DECLARATION + tostring(root, pretty_print=True)
 
 
 class MetadataConverterException(Exception):
@@ -45,54 +412,507 @@ class MetadataConverterException(Exception):
     pass
 
 
-class MetadataRecord(object):
+class OutputWriter(object):
+    """Writes record files into per-folder output directories.
 
-    def __init__(self, metadataCreator, addDate=False):
-        # create our initial tree
-        self.root_element = PYUNTL_DISPATCH['metadata']()
-        self.mapping('basic', 'meta', metadataCreator, qualifier='metadataCreator')
-        if addDate is True:
-            self.mapping('basic', 'meta', '%s' % time.strftime(
-                     '%Y-%m-%d, %H:%M:%S'), qualifier='metadataCreationDate')
+    Directories that have already been created are remembered so each
+    one costs a single makedirs call per run.  Optionally:
 
-    def __bytes__(self):
-        return untlpydict2xmlstring(untlpy2dict(self.root_element))
+    * threads: hand writes to a bounded pool of background threads
+      (at most maxPending writes are queued at a time).
+    * atomic: write to a temporary file and rename it into place.
+    * fsyncBatch: fsync written files in batches of this many, along
+      with their directories once per batch.  Atomic renames are held
+      back until their batch has been synced.
+    * skipUnchanged: leave files alone whose content on disk is already
+      the same as the data, counting them in skipped.
 
-    def __str__(self):
-        return self.__bytes__().decode()
+    Call flush() to wait for outstanding work and close() when done.
+    """
 
-    def setBaseDirectory(self, BaseDirectory):
-        self.baseDirectory = BaseDirectory
+    def __init__(self, threads=0, maxPending=256, atomic=False, fsyncBatch=0,
+                 skipUnchanged=False):
+        self.atomic = atomic
+        self.fsyncBatch = fsyncBatch
+        self.skipUnchanged = skipUnchanged
+        self.skipped = 0
+        self._createdDirectories = set()
+        self._pendingSync = []
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = set()
+        self._failed = []
+        if threads > 0:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+            self._slots = threading.BoundedSemaphore(maxPending)
 
-    def setFolderName(self, FolderName):
-        self.foldername = FolderName
+    def makeDirectory(self, writeDirectory):
+        if writeDirectory in self._createdDirectories:
+            return
+        try:
+            os.makedirs(writeDirectory)
+        except OSError:
+            if os.path.exists(writeDirectory):
+                pass  # no big deal if they exist
+            else:
+                raise MetadataConverterException(
+                    'Unable to create the output directory %s. '
+                    'Perhaps you should check permissions?' % writeDirectory)
+        with self._lock:
+            self._createdDirectories.add(writeDirectory)
 
-    def mapping(self, elementType, elementName, elementValue, qualifier=None,
-                required=True, info='', location='', agent_type='', split='',
-                function=None):
-        """
-        Mapping Function
+    def writeFile(self, baseDirectory, foldername, filename, data):
+        """Write bytes to baseDirectory/foldername/filename."""
+        writeDirectory = os.path.join(baseDirectory, foldername)
+        if self._executor is None:
+            self._writeFile(writeDirectory, filename, data)
+            return
+        self._raiseFailedWrites()
+        self._slots.acquire()
+        future = self._executor.submit(self._writeFileInBackground, writeDirectory,
+                                       filename, data)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._writeDone)
+
+    def _writeFileInBackground(self, writeDirectory, filename, data):
+        # Failures are kept until raised once, by the next writeFile or flush.
+        try:
+            self._writeFile(writeDirectory, filename, data)
+        except Exception as e:
+            with self._lock:
+                self._failed.append(e)
+
+    def _writeDone(self, future):
+        self._slots.release()
+        with self._lock:
+            self._futures.discard(future)
+
+    def _raiseFailedWrites(self):
+        with self._lock:
+            failed, self._failed = self._failed, []
+        if failed:
+            raise failed[0]
+
+    def _writeFile(self, writeDirectory, filename, data):
+        path = os.path.join(writeDirectory, filename)
+        if self.skipUnchanged and self._unchanged(path, data):
+            with self._lock:
+                self.skipped += 1
+            return
+        self.makeDirectory(writeDirectory)
+        if self.atomic:
+            tempPath = '%s.%s-%s.tmp' % (path, os.getpid(), threading.get_ident())
+            self._writeBytes(writeDirectory, tempPath, data)
+            if self.fsyncBatch > 0:
+                self._queueSync(tempPath, path)
+            else:
+                os.replace(tempPath, path)
+        else:
+            self._writeBytes(writeDirectory, path, data)
+            if self.fsyncBatch > 0:
+                self._queueSync(path, None)
+
+    def _unchanged(self, path, data):
+        # Only files of the same size are read back to compare them.
+        try:
+            if os.path.getsize(path) != len(data):
+                return False
+            with open(path, 'rb') as existingFile:
+                return existingFile.read() == data
+        except OSError:
+            return False
+
+    def _writeBytes(self, writeDirectory, path, data):
+        try:
+            outputFile = open(path, 'wb')
+        except FileNotFoundError:
+            # The directory was removed after we created it.
+            with self._lock:
+                self._createdDirectories.discard(writeDirectory)
+            self.makeDirectory(writeDirectory)
+            outputFile = open(path, 'wb')
+        with outputFile:
+            outputFile.write(data)
+
+    def _queueSync(self, path, finalPath):
+        with self._lock:
+            self._pendingSync.append((path, finalPath))
+            if len(self._pendingSync) < self.fsyncBatch:
+                return
+            batch, self._pendingSync = self._pendingSync, []
+        self._syncBatch(batch)
+
+    def _syncBatch(self, batch):
+        directories = set()
+        for path, finalPath in batch:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if finalPath is not None:
+                os.replace(path, finalPath)
+            directories.add(os.path.dirname(finalPath or path))
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def flush(self):
+        """Wait for queued writes and sync any partial fsync batch."""
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.result()
+        with self._lock:
+            batch, self._pendingSync = self._pendingSync, []
+        if batch:
+            self._syncBatch(batch)
+        self._raiseFailedWrites()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+
+class ArchiveWriter(object):
+    """Writes record files as entries of a single tar or zip archive.
+
+    Each file becomes a <foldername>/<filename> entry and is added as
+    soon as it is written, so memory use stays bounded and the whole
+    run holds one open file.  The archive type is picked from the path:
+    .zip, .tar.gz/.tgz, .tar.bz2, .tar.xz or plain .tar.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = time.time()
+        self._lock = threading.Lock()
+        if path.endswith('.zip'):
+            import zipfile
+            self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            self._tar = None
+        else:
+            mode = 'w'
+            for suffixes, compression in ((('.tar.gz', '.tgz'), 'gz'),
+                                          (('.tar.bz2',), 'bz2'),
+                                          (('.tar.xz',), 'xz')):
+                if path.endswith(suffixes):
+                    mode = 'w:' + compression
+            import tarfile
+            self._tar = tarfile.open(path, mode)
+            self._zip = None
+
+    def writeFile(self, baseDirectory, foldername, filename, data):
+        name = '%s/%s' % (foldername, filename)
+        with self._lock:
+            if self._zip is not None:
+                import zipfile
+                info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                self._zip.writestr(info, data)
+            else:
+                import tarfile
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = self.mtime
+                self._tar.addfile(info, io.BytesIO(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+            else:
+                self._tar.close()
+
+
+class CollectingWriter(object):
+    """Holds written files in memory so another process can write them."""
+
+    def __init__(self):
+        self.files = []
+
+    def writeFile(self, baseDirectory, foldername, filename, data):
+        self.files.append((baseDirectory, foldername, filename, data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class WriterThread(object):
+    """Runs another writer's writeFile calls on a background thread.
+
+    Files passed to writeFile and rows marked with rowDone share one
+    bounded queue, so writeFile blocks while maxPending items are
+    waiting, and completed() reports rows in order once all of their
+    files have been written.  The files written before a rowDone belong
+    to that row: if one fails, the row's other files are skipped and
+    the error is reported with the row, and later rows carry on.
+    """
+
+    def __init__(self, writer, maxPending=64):
+        self.writer = writer
+        self._queue = queue.Queue(maxPending)
+        self._completed = deque()
+        self._rowError = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            kind, item = self._queue.get()
+            try:
+                if kind is None:
+                    return
+                if kind == 'file':
+                    if self._rowError is None:
+                        self.writer.writeFile(*item)
+                else:
+                    self._completed.append(item + (self._rowError,))
+                    self._rowError = None
+            except BaseException as e:
+                self._rowError = e
+            finally:
+                self._queue.task_done()
+
+    def _raiseFailedWrite(self):
+        # Only files that no rowDone has claimed yet are left to fail.
+        if self._rowError is not None:
+            error, self._rowError = self._rowError, None
+            raise error
+
+    def writeFile(self, baseDirectory, foldername, filename, data):
+        self._queue.put(('file', (baseDirectory, foldername, filename, data)))
+
+    def rowDone(self, rowNumber, folder):
+        self._queue.put(('row', (rowNumber, folder)))
+
+    def completed(self):
+        """Yield (rowNumber, folder, error) for the rows whose files are done.
+
+        error is the exception of the row's first failed write, or None.
         """
+        while self._completed:
+            yield self._completed.popleft()
 
-        if elementType not in ('basic', 'agent'):
-            raise MetadataConverterException(
-                'Unsupported mapping function type, %s' % elementType)
+    def flush(self):
+        self._queue.join()
+        self._raiseFailedWrite()
+        self.writer.flush()
 
-        # strip whitespace
-        if elementValue is None:
-            return None
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put((None, None))
+            self._thread.join()
+        self.writer.close()
+        self._raiseFailedWrite()
 
-        strippedValue = elementValue.strip()
 
-        # test if the value is present if required
-        if required is True:
-            if strippedValue == '':
-                raise MetadataConverterException(
-                    'Value required for element named "%s"' % elementName)
+defaultOutputWriter = OutputWriter()
 
-        # if there isn't value don't continue
-        if strippedValue == '':
-            return None
+
+def codeFingerprint(function):
+    """Return a hash of a function's bytecode, constants and names.
+
+    It changes when the function's body is edited, so results cached
+    on disk for an older version aren't used.  Functions without
+    bytecode, such as builtins, get an empty fingerprint.
+    """
+    code = getattr(function, '__code__', function)
+    if not isinstance(code, CodeType):
+        return ''
+    digest = hashlib.sha256(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for constant in code.co_consts:
+        if isinstance(constant, CodeType):
+            constant = codeFingerprint(constant)
+        elif isinstance(constant, frozenset):
+            # Set order depends on string hashing, which varies per process.
+            constant = sorted(repr(item) for item in constant)
+        digest.update(repr(constant).encode())
+    return digest.hexdigest()
+
+
+class MemoizedTransform(object):
+    """Caches the results of a mapping(function=...) transform hook.
+
+    Results are kept in a size-bounded LRU cache.  With cachePath they
+    are also stored in an SQLite file that persists across runs and can
+    be shared by several processes.  Stored results are keyed by name
+    and by codeFingerprint, so editing the function starts afresh.
+    Without cachePath, the function is wrapped in functools.lru_cache,
+    so fast hooks pay almost nothing extra.
+
+    The SQLite file is opened on first use in each process, and again
+    after close() if the transform is still called.
+    """
+
+    def __init__(self, function, maxsize=4096, cachePath=None, name=None):
+        self.function = function
+        self.name = name or getattr(function, '__name__', repr(function))
+        self.cacheKey = '%s@%s' % (self.name, codeFingerprint(function))
+        self.cachePath = cachePath
+        self.diskHits = 0
+        self._connection = None
+        self._connectionPid = None
+        if cachePath is None:
+            self._cached = functools.lru_cache(maxsize=maxsize)(function)
+        else:
+            self._cached = None
+            self._memory = OrderedDict()
+            self._maxsize = maxsize
+            self._hits = 0
+            self._misses = 0
+
+    def _connect(self):
+        # A connection can't be shared with forked --jobs workers.
+        if self._connection is not None and self._connectionPid == os.getpid():
+            return self._connection
+        import sqlite3
+        # Autocommit in WAL mode, so processes sharing the file never
+        # hold a write lock between rows and readers don't wait for
+        # writers.
+        connection = sqlite3.connect(self.cachePath, timeout=60, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS transforms '
+            '(name TEXT, input TEXT, output TEXT, PRIMARY KEY (name, input))')
+        self._connection, self._connectionPid = connection, os.getpid()
+        return connection
+
+    def __call__(self, value):
+        if self._cached is not None:
+            return self._cached(value)
+        try:
+            result = self._memory[value]
+        except KeyError:
+            pass
+        else:
+            self._memory.move_to_end(value)
+            self._hits += 1
+            return result
+
+        self._misses += 1
+        connection = self._connect()
+        row = connection.execute(
+            'SELECT output FROM transforms WHERE name = ? AND input = ?',
+            (self.cacheKey, value)).fetchone()
+        if row is not None:
+            self.diskHits += 1
+            result = json.loads(row[0])
+        else:
+            result = self.function(value)
+            connection.execute(
+                'INSERT OR REPLACE INTO transforms VALUES (?, ?, ?)',
+                (self.cacheKey, value, json.dumps(result)))
+        self._memory[value] = result
+        if self._maxsize is not None and len(self._memory) > self._maxsize:
+            self._memory.popitem(last=False)
+        return result
+
+    @property
+    def hits(self):
+        if self._cached is not None:
+            return self._cached.cache_info().hits
+        return self._hits + self.diskHits
+
+    @property
+    def misses(self):
+        if self._cached is not None:
+            return self._cached.cache_info().misses
+        return self._misses - self.diskHits
+
+    def close(self):
+        if self._connection is not None and self._connectionPid == os.getpid():
+            self._connection.close()
+            self._connection = None
+
+
+class TransformRegistry(object):
+    """Keeps track of memoized transforms so their hit rates can be reported.
+
+    Transforms are kept until close(), even if another one has the same
+    name, since mapping functions may still call them.  Their counts
+    are reported together under that name.
+    """
+
+    def __init__(self):
+        self.transforms = []
+        self._reported = {}
+
+    def register(self, transform):
+        if transform not in self.transforms:
+            self.transforms.append(transform)
+        return transform
+
+    def drainCounts(self):
+        """Return {name: (hits, misses)} accumulated since the last call."""
+        counts = {}
+        for transform in self.transforms:
+            hits, misses = transform.hits, transform.misses
+            lastHits, lastMisses = self._reported.get(transform, (0, 0))
+            if hits != lastHits or misses != lastMisses:
+                nameHits, nameMisses = counts.get(transform.name, (0, 0))
+                counts[transform.name] = (nameHits + hits - lastHits,
+                                          nameMisses + misses - lastMisses)
+            self._reported[transform] = (hits, misses)
+        return counts
+
+    def close(self):
+        for transform in self.transforms:
+            transform.close()
+
+
+transformRegistry = TransformRegistry()
+
+
+def memoize(function=None, maxsize=4096, cachePath=None, name=None):
+    """Wrap a transform hook in a MemoizedTransform.
+
+    Works as a plain call or as a decorator, with or without options::
+
+        @memoize(maxsize=10000, cachePath='dates.sqlite')
+        def normalizeDate(value):
+            ...
+
+    Memoized transforms are registered in transformRegistry.
+    """
+    def wrap(function):
+        return transformRegistry.register(
+            MemoizedTransform(function, maxsize=maxsize, cachePath=cachePath, name=name))
+    if function is None:
+        return wrap
+    return wrap(function)
+
+
+class FieldMapping(object):
+    """A validated mapping of values onto one UNTL element.
+
+    All checks that don't depend on the value itself are done once when
+    the FieldMapping is created, leaving only the per-value work for
+    each row.
+    """
+
+    def __init__(self, elementType, elementName, qualifier=None, required=True,
+                 info='', location='', agent_type='', split='', function=None,
+                 column=None):
+        if elementType not in ('basic', 'agent'):
+            raise MetadataConverterException(
+                'Unsupported mapping function type, %s' % elementType)
 
         if elementName not in fieldTypes:
             raise MetadataConverterException(
@@ -106,124 +926,2222 @@ class MetadataRecord(object):
 
         if location.strip() != '' and elementName != 'publisher':
             raise MetadataConverterException('location can only be used on publisher element')
+
+        self.elementType = elementType
+        self.elementName = elementName
+        self.column = column
+        self.required = required is True
+        if qualifier and qualifier.strip() != '':
+            self.qualifier = qualifier
+        else:
+            self.qualifier = None
+        self.info = info.strip()
+        self.location = location.strip()
+        self.agent_type = agent_type.strip()
+        self.split = split if split.strip() != '' else None
+        self.function = function
+
+    def prepareValues(self, strippedValue):
+        """Split a stripped value and run it through the function hook."""
         # If split is set then split on the split pattern,
         # creating an element for each
-
-        if split.strip() != '':
-            valueList = [elem.strip() for elem in strippedValue.split(split)]
+        if self.split is not None:
+            valueList = [elem.strip() for elem in strippedValue.split(self.split)]
         else:
             valueList = [strippedValue]
+        return self.transformValues(valueList)
 
-        if elementType == 'basic':
-            for value in valueList:
-                if function:
-                    value = function(value)
-                sub = PYUNTL_DISPATCH[elementName]()
-                if qualifier and qualifier.strip() != '':
-                    sub.set_qualifier(qualifier)
-                sub.set_content(value)
-                self.root_element.add_child(sub)
-        elif elementType == 'agent':
-            for value in valueList:
-                if function:
-                    value = function(value)
-                agent = PYUNTL_DISPATCH[elementName]()
-                if qualifier and qualifier.strip() != '':
-                    agent.set_qualifier(qualifier)
-                agent.add_child(
-                    PYUNTL_DISPATCH['name'](content=value))
-                if info.strip() != '':
-                    agent.add_child(
-                        PYUNTL_DISPATCH['info'](content=info.strip()))
-                if location.strip() != '':
-                    agent.add_child(
-                        PYUNTL_DISPATCH['location'](content=location.strip()))
-                if agent_type.strip() != '':
-                    agent.add_child(
-                        PYUNTL_DISPATCH['type'](content=agent_type.strip()))
-                self.root_element.add_child(agent)
-
-    def writeTemplateFiles(self, baseDirectory, foldername):
-        writeDirectory = os.path.join(baseDirectory, foldername)
-        try:
-            os.makedirs(writeDirectory)
-        except OSError:
-            if os.path.exists(writeDirectory):
-                pass  # no big deal if they exist
-            else:
+    def transformValues(self, valueList):
+        """Run already split values through the function hook."""
+        if self.function:
+            valueList = [self.function(value) for value in valueList]
+        return valueList
+
+    def apply(self, record, elementValue):
+        """Add the elements for one row's value to a record."""
+        if elementValue is None:
+            return None
+        strippedValue = elementValue.strip()
+        if strippedValue == '':
+            if self.required:
                 raise MetadataConverterException(
-                    'Unable to create the output directory %s. ' +
-                    'Perhaps you should check permissions?' %
-                    writeDirectory)
-        with open(os.path.join(writeDirectory, 'metadata.xml'), 'wb') as templateFile:
-            templateFile.write(self.__bytes__())
-        return '%s finished' % foldername
+                    'Value required for element named "%s"' % self.elementName)
+            return None
+        record.addMappedValues(self, self.prepareValues(strippedValue))
 
-    def writeJSONFile(self, baseDirectory, foldername, data):
-        writeDirectory = os.path.join(baseDirectory, foldername)
-        try:
-            os.makedirs(writeDirectory)
-        except OSError:
-            if os.path.exists(writeDirectory):
-                pass  # no big deal if they exist
-            else:
+
+class MappingPlan(object):
+    """A mapping spec compiled once and applied to every row.
+
+    Mapping files can define a MAPPING dict instead of a processRecord
+    function::
+
+        MAPPING = {
+            'metadataCreator': 'mphillips',
+            'baseDirectory': 'records',
+            'folderName': 'isbn',
+            'fields': [
+                {'type': 'basic', 'element': 'title', 'column': 'title',
+                 'qualifier': 'officialtitle'},
+                {'type': 'agent', 'element': 'creator', 'column': 'author',
+                 'qualifier': 'aut', 'agent_type': 'per'},
+            ],
+        }
+
+    Each field takes the same options as MetadataRecord.mapping.
+    """
+
+    fieldOptions = ('qualifier', 'required', 'info', 'location',
+                    'agent_type', 'split', 'function')
+
+    def __init__(self, fields, metadataCreator, baseDirectory=None,
+                 folderName=None, addDate=False):
+        self.fields = fields
+        self.metadataCreator = metadataCreator
+        self.baseDirectory = baseDirectory
+        self.folderName = folderName
+        self.addDate = addDate
+
+    @classmethod
+    def compile(cls, spec):
+        """Validate a mapping spec and return a MappingPlan for it."""
+        unknown = set(spec) - {'metadataCreator', 'baseDirectory', 'folderName',
+                               'addDate', 'fields'}
+        if unknown:
+            raise MetadataConverterException(
+                'Unknown mapping option(s): %s' % ', '.join(sorted(unknown)))
+        if 'metadataCreator' not in spec:
+            raise MetadataConverterException('Mapping requires a metadataCreator')
+
+        fields = []
+        for fieldSpec in spec.get('fields', []):
+            fieldSpec = dict(fieldSpec)
+            try:
+                elementType = fieldSpec.pop('type')
+                elementName = fieldSpec.pop('element')
+                column = fieldSpec.pop('column')
+            except KeyError as e:
                 raise MetadataConverterException(
-                    'Unable to create the output directory %s. '
-                    'Perhaps you should check permissions?' % writeDirectory)
-        with open(os.path.join(writeDirectory, 'metadata.json'), 'w') as jsonFilename:
-            jsonFilename.write(json.dumps(data,
-                               sort_keys=True,
-                               indent=4,
-                               separators=(',', ': ')))
+                    'Mapping field is missing "%s": %r' % (e.args[0], fieldSpec))
+            unknown = set(fieldSpec) - set(cls.fieldOptions)
+            if unknown:
+                raise MetadataConverterException(
+                    'Unknown option(s) for element "%s": %s'
+                    % (elementName, ', '.join(sorted(unknown))))
+            fields.append(FieldMapping(elementType, elementName, column=column, **fieldSpec))
 
-        return '%s finished JSON' % foldername
+        return cls(fields, spec['metadataCreator'],
+                   baseDirectory=spec.get('baseDirectory'),
+                   folderName=spec.get('folderName'),
+                   addDate=spec.get('addDate', False))
 
+    def processRecord(self, RecordClass, row):
+        """Build a record from a row, like a mapping file's processRecord.
 
-if __name__ == '__main__':
+        Values already cleaned by a ColumnarPreprocessor are used as they
+        are; other cells are handled by FieldMapping.apply.
+        """
+        record = RecordClass(self.metadataCreator, addDate=self.addDate)
+        preparedValues = getattr(row, 'preparedValues', None)
+        for index, field in enumerate(self.fields):
+            # Compare by type, since rows sent to --jobs workers carry
+            # copies of ROW_BY_ROW.
+            prepared = ROW_BY_ROW if preparedValues is None else preparedValues[index]
+            if isinstance(prepared, list):
+                record.applyPreparedField(field, prepared)
+            elif prepared is not None:
+                record.applyField(field, row[field.column])
+        if self.baseDirectory is not None:
+            record.setBaseDirectory(self.baseDirectory)
+        if self.folderName is not None:
+            record.setFolderName(row[self.folderName])
+        return record
 
-    parser = ArgumentParser()
-    parser.add_argument('csv_file',
-                        help='Specify a CSV file to process.')
-    parser.add_argument('-m', '--mapping', required=True,
-                        help='Specify the mapping file to use for this CSV')
-    parser.add_argument('-n', '--row', type=int,
-                        dest='row',
-                        help='Specify a single row number to process')
-    parser.add_argument('-w', '--write', action='store_true',
-                        dest='write',
-                        help='Write records to files')
-    parser.add_argument('-j', '--json', action='store_true',
-                        dest='json',
-                        help='Write json version of metadata')
-    args = parser.parse_args()
 
-    print('Processing CSV file %s with mapping %s' % (args.csv_file, args.mapping))
-    mappingPath = os.path.abspath(args.mapping)
-    CSVPath = os.path.abspath(args.csv_file)
-    CSVRows = CSVToDict(CSVPath)
-    localDict = {}
-    exec(compile(open(mappingPath).read(), mappingPath, 'exec'), {}, localDict)
-    mappingFunction = localDict['processRecord']
-
-    if args.row:
-        if args.row < 0:
-            sys.exit('row must be a positive integer.')
-        try:
-            CSVRows = [CSVRows[args.row - 1]]
-        except IndexError:
-            sys.exit('Sorry, %s is not a valid row number.' % args.row)
+# Marks a cell that ColumnarPreprocessor leaves to FieldMapping.apply.
+ROW_BY_ROW = object()
 
-    for x in range(len(CSVRows)):
-        row = CSVRows[x]
-        if args.write:
-            print('Writing record for row %s' % x)
-            record = mappingFunction(MetadataRecord, row)
-            record.writeTemplateFiles(record.baseDirectory, record.foldername)
-        if args.json:
-            print('Writing json record for row %s' % x)
-            record = mappingFunction(MetadataRecord, row)
-            record.writeJSONFile(record.baseDirectory, record.foldername, row)
-        else:
-            print('Processing row %s' % x)
-            record = mappingFunction(MetadataRecord, row)
-            print(record)
+# Characters str.strip() removes, for backends that need them spelled out.
+WHITESPACE = ''.join(chr(c) for c in range(0x3001) if chr(c).isspace())
+
+
+def _stripColumn(values):
+    return [value.strip() for value in values]
+
+
+def _splitColumn(values, separator):
+    return [[elem.strip() for elem in value.split(separator)] for value in values]
+
+
+def _stripColumnNumpy(values):
+    # Fixed width numpy strings drop trailing NULs, which str.strip keeps.
+    if not values or '\x00' in ''.join(values):
+        return _stripColumn(values)
+    return numpy.char.strip(numpy.array(values, dtype=str), WHITESPACE).tolist()
+
+
+def _splitColumnNumpy(values, separator):
+    if not values or '\x00' in ''.join(values):
+        return _splitColumn(values, separator)
+    return _regroup(values, numpy.char.split(numpy.array(values, dtype=str), separator).tolist(),
+                    _stripColumnNumpy)
+
+
+def _stripColumnArrow(values):
+    strings = pyarrow.array(values, type=pyarrow.string())
+    return pyarrow.compute.utf8_trim(strings, characters=WHITESPACE).to_pylist()
+
+
+def _splitColumnArrow(values, separator):
+    strings = pyarrow.array(values, type=pyarrow.string())
+    parts = pyarrow.compute.split_pattern(strings, pattern=separator)
+    elems = pyarrow.compute.utf8_trim(parts.flatten(), characters=WHITESPACE).to_pylist()
+    offsets = parts.offsets.to_pylist()
+    return [elems[offsets[n]:offsets[n + 1]] for n in range(len(values))]
+
+
+def _regroup(values, parts, stripColumn):
+    """Strip every split part in one pass and group them back per value."""
+    elems = stripColumn([elem for valueParts in parts for elem in valueParts])
+    grouped = []
+    position = 0
+    for valueParts in parts:
+        grouped.append(elems[position:position + len(valueParts)])
+        position += len(valueParts)
+    return grouped
+
+
+COLUMNAR_BACKENDS = {
+    'pyarrow': (_stripColumnArrow, _splitColumnArrow),
+    'numpy': (_stripColumnNumpy, _splitColumnNumpy),
+    'python': (_stripColumn, _splitColumn),
+}
+
+
+def columnarBackends():
+    """Return the installed columnar backends, fastest first."""
+    loadColumnarModules()
+    installed = {'pyarrow': pyarrow, 'numpy': numpy, 'python': True}
+    return [name for name in COLUMNAR_BACKENDS if installed[name] is not None]
+
+
+class PreparedRow(dict):
+    """A CSV row dict carrying the values cleaned by a ColumnarPreprocessor."""
+
+    preparedValues = None
+
+
+class ColumnarPreprocessor(object):
+    """Cleans a MappingPlan's columns a chunk of rows at a time.
+
+    Whitespace stripping, the required value check and split handling
+    are done for a whole column at once, with pyarrow or NumPy if either
+    is installed, before the records are built.  Cells that can't be
+    cleaned up front, such as a missing required value, are left to
+    FieldMapping.apply so that errors are raised for the same row and
+    with the same message as without preprocessing.
+    """
+
+    def __init__(self, fields, backend=None, chunkSize=1024):
+        if backend is None:
+            backend = columnarBackends()[0]
+        if backend not in columnarBackends():
+            raise MetadataConverterException(
+                'Columnar backend "%s" is not available' % backend)
+        self.fields = fields
+        self.backend = backend
+        self.chunkSize = chunkSize
+        self.stripColumn, self.splitColumn = COLUMNAR_BACKENDS[backend]
+
+    def prepareColumn(self, field, values):
+        """Return the value list to add for each cell of a column.
+
+        A cell gets None when it adds nothing and ROW_BY_ROW when it
+        has to go through FieldMapping.apply.
+        """
+        prepared = [None if value is None else ROW_BY_ROW for value in values]
+        positions = [n for n, value in enumerate(values) if type(value) is str]
+        stripped = self.stripColumn([values[n] for n in positions])
+
+        present = []
+        for n, strippedValue in zip(positions, stripped):
+            if strippedValue != '':
+                present.append((n, strippedValue))
+            elif not field.required:
+                prepared[n] = None
+        if field.split is not None:
+            valueLists = self.splitColumn([value for _, value in present], field.split)
+        else:
+            valueLists = [[value] for _, value in present]
+        for (n, _), valueList in zip(present, valueLists):
+            prepared[n] = valueList
+        return prepared
+
+    def preprocessRows(self, numberedRows, stats=None):
+        """Yield (rowNumber, PreparedRow) pairs for (rowNumber, row) pairs.
+
+        Time spent cleaning columns is added to the parse stage of stats.
+        """
+        numberedRows = iter(numberedRows)
+        while True:
+            chunk = list(islice(numberedRows, self.chunkSize))
+            if not chunk:
+                return
+            started = time.perf_counter()
+            rows = [row for _, row in chunk]
+            columns = [self.prepareColumn(field, [row.get(field.column, ROW_BY_ROW)
+                                                  for row in rows])
+                       for field in self.fields]
+            if stats is not None:
+                stats.add('parse', time.perf_counter() - started)
+            for n, (rowNumber, row) in enumerate(chunk):
+                row = PreparedRow(row)
+                row.preparedValues = [column[n] for column in columns]
+                yield rowNumber, row
+
+
+def buildFieldElement(field, value):
+    """Build the pyuntl element for one value of a FieldMapping."""
+    loadUNTL()
+    if field.elementType == 'basic':
+        sub = PYUNTL_DISPATCH[field.elementName]()
+        if field.qualifier is not None:
+            sub.set_qualifier(field.qualifier)
+        sub.set_content(value)
+        return sub
+
+    agent = PYUNTL_DISPATCH[field.elementName]()
+    if field.qualifier is not None:
+        agent.set_qualifier(field.qualifier)
+    agent.add_child(
+        PYUNTL_DISPATCH['name'](content=value))
+    if field.info != '':
+        agent.add_child(
+            PYUNTL_DISPATCH['info'](content=field.info))
+    if field.location != '':
+        agent.add_child(
+            PYUNTL_DISPATCH['location'](content=field.location))
+    if field.agent_type != '':
+        agent.add_child(
+            PYUNTL_DISPATCH['type'](content=field.agent_type))
+    return agent
+
+
+class NodeCache(object):
+    """A bounded LRU cache of prebuilt pyuntl elements.
+
+    Elements are keyed by (element, qualifier, value, info, location,
+    agent_type), so the creator, publisher, rights or collection values
+    that repeat on most rows are built once and the same element is
+    shared by every record that uses it.  Shared elements must not be
+    modified after they are added to a record.
+    """
+
+    def __init__(self, maxsize=4096, stats=None):
+        self.maxsize = maxsize
+        self.stats = stats
+        self.hits = 0
+        self.misses = 0
+        self._nodes = OrderedDict()
+
+    def node(self, field, value):
+        key = (field.elementName, field.qualifier, value, field.info,
+               field.location, field.agent_type)
+        node = self._nodes.get(key)
+        if node is not None:
+            self._nodes.move_to_end(key)
+            self.hits += 1
+            if self.stats is not None:
+                self.stats.count('nodeCacheHits')
+            return node
+        node = buildFieldElement(field, value)
+        self._nodes[key] = node
+        if len(self._nodes) > self.maxsize:
+            self._nodes.popitem(last=False)
+        self.misses += 1
+        if self.stats is not None:
+            self.stats.count('nodeCacheMisses')
+        return node
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._nodes), 'maxsize': self.maxsize}
+
+
+def cachedRecordClass(nodeCache, RecordClass=None):
+    """Return a subclass of RecordClass that builds elements through nodeCache."""
+    RecordClass = RecordClass or MetadataRecord
+    return type(RecordClass.__name__, (RecordClass,), {'nodeCache': nodeCache})
+
+
+CREATION_DATE_FORMAT = '%Y-%m-%d, %H:%M:%S'
+
+
+class RecordContext(object):
+    """Settings the driver shares with every record of a run.
+
+    creationDate is the metadataCreationDate that addDate adds.  If it
+    is None, each record reads the clock when it is created; otherwise
+    every record gets the same, already formatted date.
+    """
+
+    def __init__(self, creationDate=None):
+        self.creationDate = creationDate
+
+    @classmethod
+    def fixed(cls):
+        """Return a context whose creationDate is the current time, read once."""
+        return cls(time.strftime(CREATION_DATE_FORMAT))
+
+    def metadataCreationDate(self):
+        if self.creationDate is None:
+            return time.strftime(CREATION_DATE_FORMAT)
+        return self.creationDate
+
+
+def contextRecordClass(context, RecordClass=None):
+    """Return a subclass of RecordClass whose records use context."""
+    RecordClass = RecordClass or MetadataRecord
+    return type(RecordClass.__name__, (RecordClass,), {'context': context})
+
+
+class MetadataRecord(object):
+
+    # Set through cachedRecordClass to share prebuilt elements.
+    nodeCache = None
+    # Set through contextRecordClass to share a run's settings.
+    context = RecordContext()
+
+    def __init__(self, metadataCreator, addDate=False):
+        # create our initial tree
+        self.root_element = self.newRootElement()
+        self.mapping('basic', 'meta', metadataCreator, qualifier='metadataCreator')
+        if addDate is True:
+            self.mapping('basic', 'meta', self.context.metadataCreationDate(),
+                         qualifier='metadataCreationDate')
+
+    def newRootElement(self):
+        loadUNTL()
+        return PYUNTL_DISPATCH['metadata']()
+
+    def __bytes__(self):
+        return serializeUNTL(self.root_element)
+
+    def __str__(self):
+        return self.__bytes__().decode()
+
+    def setBaseDirectory(self, BaseDirectory):
+        self.baseDirectory = BaseDirectory
+
+    def setFolderName(self, FolderName):
+        self.foldername = FolderName
+
+    def mapping(self, elementType, elementName, elementValue, qualifier=None,
+                required=True, info='', location='', agent_type='', split='',
+                function=None):
+        """
+        Mapping Function
+        """
+
+        if elementType not in ('basic', 'agent'):
+            raise MetadataConverterException(
+                'Unsupported mapping function type, %s' % elementType)
+
+        # strip whitespace
+        if elementValue is None:
+            return None
+
+        strippedValue = elementValue.strip()
+
+        # test if the value is present if required
+        if required is True:
+            if strippedValue == '':
+                raise MetadataConverterException(
+                    'Value required for element named "%s"' % elementName)
+
+        # if there isn't value don't continue
+        if strippedValue == '':
+            return None
+
+        field = FieldMapping(elementType, elementName, qualifier=qualifier,
+                             required=required, info=info, location=location,
+                             agent_type=agent_type, split=split, function=function)
+        self.addMappedValues(field, field.prepareValues(strippedValue))
+
+    def applyField(self, field, elementValue):
+        """Add the elements for a compiled FieldMapping's value."""
+        return field.apply(self, elementValue)
+
+    def applyPreparedField(self, field, valueList):
+        """Add the elements for values a ColumnarPreprocessor already cleaned."""
+        self.addMappedValues(field, field.transformValues(valueList))
+
+    def addMappedValues(self, field, valueList):
+        """Add an element to the tree for each value of a validated field."""
+        if self.nodeCache is not None:
+            for value in valueList:
+                self.root_element.add_child(self.nodeCache.node(field, value))
+        else:
+            for value in valueList:
+                self.root_element.add_child(buildFieldElement(field, value))
+
+    def writeTemplateFiles(self, baseDirectory, foldername, writer=None):
+        writer = writer or defaultOutputWriter
+        writer.writeFile(baseDirectory, foldername, 'metadata.xml', self.__bytes__())
+        return '%s finished' % foldername
+
+    def writeJSONFile(self, baseDirectory, foldername, data, writer=None):
+        writer = writer or defaultOutputWriter
+        writer.writeFile(baseDirectory, foldername, 'metadata.json',
+                         json.dumps(data,
+                                    sort_keys=True,
+                                    indent=4,
+                                    separators=(',', ': ')).encode())
+
+        return '%s finished JSON' % foldername
+
+
+class ValidatingRecord(MetadataRecord):
+    """A record that checks mapped values without building a tree.
+
+    mapping() still validates the element type, the fieldTypes entry and
+    required values, and runs function hooks, but no elements are built.
+    """
+
+    def newRootElement(self):
+        return None
+
+    def __bytes__(self):
+        raise MetadataConverterException('A ValidatingRecord has no tree to serialize')
+
+    def addMappedValues(self, field, valueList):
+        pass
+
+
+# Field configurations pyuntl has accepted, most recently used last.
+_acceptedFields = OrderedDict()
+_acceptedFieldsLock = threading.Lock()
+ACCEPTED_FIELDS_SIZE = 1024
+
+
+def checkFieldElement(field):
+    """Raise pyuntl's error if it doesn't allow a FieldMapping's qualifier or children.
+
+    Only which children are set matters to pyuntl, so each configuration
+    is built once and the last ACCEPTED_FIELDS_SIZE accepted are kept.
+    """
+    key = (field.elementType, field.elementName, field.qualifier, field.info != '',
+           field.location != '', field.agent_type != '')
+    with _acceptedFieldsLock:
+        if key in _acceptedFields:
+            _acceptedFields.move_to_end(key)
+            return
+    buildFieldElement(field, '')
+    with _acceptedFieldsLock:
+        _acceptedFields[key] = True
+        if len(_acceptedFields) > ACCEPTED_FIELDS_SIZE:
+            _acceptedFields.popitem(last=False)
+
+
+class CompactRecord(MetadataRecord):
+    """A record that keeps its elements as tuples until a tree is needed.
+
+    Mapped values are stored in elements as (tag, qualifier, content,
+    children) tuples and serialized straight from them.  The pyuntl tree
+    is only built the first time root_element is used, and from then on
+    the tree is kept up to date instead.
+    """
+
+    def __init__(self, metadataCreator, addDate=False):
+        self.elements = []
+        super().__init__(metadataCreator, addDate=addDate)
+
+    def newRootElement(self):
+        return None
+
+    @property
+    def root_element(self):
+        if self._root is None:
+            loadUNTL()
+            root = PYUNTL_DISPATCH['metadata']()
+            for tag, qualifier, content, children in self.elements:
+                element = PYUNTL_DISPATCH[tag]()
+                if qualifier is not None:
+                    element.set_qualifier(qualifier)
+                if children:
+                    for childTag, childContent in children:
+                        element.add_child(PYUNTL_DISPATCH[childTag](content=childContent))
+                else:
+                    element.set_content(content)
+                root.add_child(element)
+            self._root = root
+        return self._root
+
+    @root_element.setter
+    def root_element(self, rootElement):
+        self._root = rootElement
+
+    def __bytes__(self):
+        if self._root is not None:
+            return serializeUNTL(self._root)
+        return serializeElements(self.elements)
+
+    def addMappedValues(self, field, valueList):
+        if self._root is not None:
+            return super().addMappedValues(field, valueList)
+        # Let pyuntl raise the same errors for a qualifier or child it
+        # doesn't allow as it would when building the tree.
+        checkFieldElement(field)
+        # pyuntl strips qualifiers and content as they are set.
+        qualifier = field.qualifier.strip() if field.qualifier is not None else None
+        if field.elementType == 'basic':
+            for value in valueList:
+                self.elements.append((field.elementName, qualifier, value.strip(), ()))
+            return
+        extraChildren = tuple((childTag, content) for childTag, content in
+                              (('info', field.info), ('location', field.location),
+                               ('type', field.agent_type)) if content != '')
+        for value in valueList:
+            name = ('name', value.strip() if value is not None else None)
+            self.elements.append((field.elementName, qualifier, None,
+                                  (name,) + extraChildren))
+
+
+def loadMappingFunction(mappingPath):
+    """Compile a mapping file and return its processRecord function.
+
+    A mapping file that defines a MAPPING spec instead is compiled into
+    a MappingPlan.  Mapping files can use memoize without importing it.
+    """
+    localDict = {'memoize': memoize}
+    with open(mappingPath) as mappingFile:
+        exec(compile(mappingFile.read(), mappingPath, 'exec'), localDict)
+    if 'processRecord' in localDict:
+        return localDict['processRecord']
+    if 'MAPPING' in localDict:
+        return MappingPlan.compile(localDict['MAPPING']).processRecord
+    raise MetadataConverterException(
+        'Mapping file %s defines neither processRecord nor MAPPING' % mappingPath)
+
+
+# Compiled mappings by path, kept while the file's mtime and size match.
+_mappingCache = {}
+
+
+def cachedMappingFunction(mappingPath):
+    """Return loadMappingFunction(mappingPath), compiling each file only once.
+
+    The file is compiled again if it changes on disk.
+    """
+    status = os.stat(mappingPath)
+    key = (status.st_mtime_ns, status.st_size)
+    cached = _mappingCache.get(mappingPath)
+    if cached is None or cached[0] != key:
+        cached = _mappingCache[mappingPath] = (key, loadMappingFunction(mappingPath))
+    return cached[1]
+
+
+class BatchInput(object):
+    """One CSV file of a batch run, with the mapping file that converts it."""
+
+    def __init__(self, CSVPath, mappingPath):
+        self.CSVPath = CSVPath
+        self.mappingPath = mappingPath
+        self.rows = 0
+        self.rejects = None
+
+    @property
+    def rejected(self):
+        return self.rejects.count if self.rejects is not None else 0
+
+
+class BatchRow(dict):
+    """A CSV row dict that knows which batch input it came from."""
+
+    __slots__ = ('CSVPath', 'mappingPath')
+
+
+def batchRows(inputs, progress=None, reader=None, **options):
+    """Yield (rowNumber, BatchRow) pairs for every row of every BatchInput.
+
+    Row numbers start again at 0 for each CSV file.  Each file is read
+    with readRows, passing on reader and options.
+    """
+    for batchInput in inputs:
+        rows = readRows(batchInput.CSVPath, reader, progress=progress, **options)
+        for rowNumber, row in enumerate(rows):
+            row = BatchRow(row)
+            row.CSVPath = batchInput.CSVPath
+            row.mappingPath = batchInput.mappingPath
+            batchInput.rows += 1
+            yield rowNumber, row
+
+
+def batchMappingFunction(RecordClass, row):
+    """Build a record for a BatchRow with its own input's mapping."""
+    return cachedMappingFunction(row.mappingPath)(RecordClass, row)
+
+
+def globPaths(pattern, kind='files'):
+    """Return the sorted paths matching a glob pattern, or a plain path as it is."""
+    import glob
+    if glob.escape(pattern) == pattern:
+        return [pattern]
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise MetadataConverterException('No %s match %s' % (kind, pattern))
+    return paths
+
+
+def batchInputs(CSVFiles, mappingPath=None, manifestPath=None):
+    """Pair CSV files with the mapping files that convert them.
+
+    CSVFiles may hold glob patterns and are all converted with
+    mappingPath.  A manifest is a CSV file with csv and mapping columns,
+    whose relative paths are relative to the manifest.  Returns a list
+    of (CSVPath, mappingPath) pairs without repeats, in the order given.
+    """
+    pairs = [(CSVFile, mappingPath) for CSVFile in CSVFiles]
+    if manifestPath is not None:
+        directory = os.path.dirname(manifestPath)
+        for row in iterCSVToDict(manifestPath):
+            if not row.get('csv') or not row.get('mapping'):
+                raise MetadataConverterException(
+                    'Batch manifest %s needs a csv and a mapping for every row' % manifestPath)
+            pairs.append((os.path.join(directory, row['csv']),
+                          os.path.join(directory, row['mapping'])))
+    inputs = []
+    for pattern, mapping in pairs:
+        for CSVPath in globPaths(pattern, 'CSV files'):
+            if (CSVPath, mapping) not in inputs:
+                inputs.append((CSVPath, mapping))
+    return inputs
+
+
+def batchRejectsPath(rejectsPath, CSVPath, taken):
+    """Name the rejects file of one batch input after its CSV file."""
+    stem, extension = os.path.splitext(rejectsPath)
+    name = '%s-%s' % (stem, os.path.splitext(os.path.basename(CSVPath))[0])
+    path = name + extension
+    suffix = 1
+    while path in taken:
+        suffix += 1
+        path = '%s-%s%s' % (name, suffix, extension)
+    taken.add(path)
+    return path
+
+
+def batchSummary(inputs):
+    """Summarize the rows read and rejected for each input of a batch run."""
+    lines = ['%s CSV files: %s rows, %s rejected'
+             % (len(inputs), sum(i.rows for i in inputs), sum(i.rejected for i in inputs))]
+    for batchInput in inputs:
+        lines.append('  %s: %s rows, %s rejected'
+                     % (batchInput.CSVPath, batchInput.rows, batchInput.rejected))
+    return '\n'.join(lines)
+
+
+class JSONLinesWriter(object):
+    """Streams one compact JSON object per record to a single file.
+
+    Each line holds the record's foldername and the row data written by
+    writeJSONFile, plus the serialized UNTL record if includeUNTL is set.
+    """
+
+    def __init__(self, stream, includeUNTL=False):
+        self.stream = stream
+        self.includeUNTL = includeUNTL
+
+    def formatRecord(self, record, row):
+        line = {'foldername': getattr(record, 'foldername', None), 'data': row}
+        if self.includeUNTL:
+            line['untl'] = str(record)
+        return json.dumps(line, ensure_ascii=False, separators=(',', ':'))
+
+    def writeRecord(self, record, row):
+        self.stream.write(self.formatRecord(record, row) + '\n')
+
+
+class FolderIndex(object):
+    """Remembers which row each output folder was written for in this run.
+
+    When a later row resolves to a folder that is already taken, claim()
+    applies the policy: warn prints a message and overwrites the files,
+    error raises, skip keeps the earlier row's files and suffix writes
+    to the first free foldername-2, foldername-3, ... instead.
+    """
+
+    policies = ('warn', 'error', 'skip', 'suffix')
+
+    def __init__(self, policy='warn'):
+        if policy not in self.policies:
+            raise MetadataConverterException('Unknown collision policy %s' % policy)
+        self.policy = policy
+        self.rows = {}
+        self.collisions = 0
+
+    def claim(self, rowNumber, baseDirectory, foldername, stream=None):
+        """Return the foldername to write rowNumber to, or None to skip it."""
+        folder = os.path.join(baseDirectory, foldername)
+        if folder not in self.rows:
+            self.rows[folder] = rowNumber
+            return foldername
+        self.collisions += 1
+        message = 'Row %s has the same folder %s as row %s' % (rowNumber, folder,
+                                                               self.rows[folder])
+        if self.policy == 'error':
+            raise MetadataConverterException(message)
+        if self.policy == 'skip':
+            print('%s, skipping it' % message, file=stream or sys.stdout)
+            return None
+        if self.policy == 'suffix':
+            suffix = 2
+            while os.path.join(baseDirectory, '%s-%s' % (foldername, suffix)) in self.rows:
+                suffix += 1
+            foldername = '%s-%s' % (foldername, suffix)
+            self.rows[os.path.join(baseDirectory, foldername)] = rowNumber
+            print('%s, writing to %s' % (message, foldername), file=stream or sys.stdout)
+            return foldername
+        print('%s, overwriting it' % message, file=stream or sys.stdout)
+        self.rows[folder] = rowNumber
+        return foldername
+
+
+def emitRecord(record, row, rowNumber, write=False, writeJSON=False, stream=None,
+               writer=None, jsonLines=None, verbose=True, folders=None):
+    """Send one built record to every requested output.
+
+    The record is written as metadata.xml and/or metadata.json through
+    writer, and/or as a line of jsonLines, or printed to stream (stdout
+    by default) when no file output is requested.  File writes are
+    announced on stream when verbose is set.  With a FolderIndex as
+    folders, the record's folder is claimed first; returns False if the
+    record was skipped because of it.
+    """
+    if stream is None:
+        stream = sys.stdout
+    if folders is not None and (write or writeJSON):
+        foldername = folders.claim(rowNumber, record.baseDirectory, record.foldername, stream)
+        if foldername is None:
+            return False
+        record.setFolderName(foldername)
+    if write:
+        if verbose:
+            print('Writing record for row %s' % rowNumber, file=stream)
+        record.writeTemplateFiles(record.baseDirectory, record.foldername, writer=writer)
+    if writeJSON:
+        if verbose:
+            print('Writing json record for row %s' % rowNumber, file=stream)
+        record.writeJSONFile(record.baseDirectory, record.foldername, row, writer=writer)
+    if jsonLines is not None:
+        jsonLines.writeRecord(record, row)
+    if not write and not writeJSON and jsonLines is None:
+        print('Processing row %s' % rowNumber, file=stream)
+        print(record, file=stream)
+    return True
+
+
+def hashFile(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hashRow(row):
+    """Return a stable content hash for a CSV row dict."""
+    return hashlib.sha256(
+        json.dumps(list(row.items()), ensure_ascii=False).encode()).hexdigest()
+
+
+class IncrementalManifest(object):
+    """Tracks which output folders were built from which rows.
+
+    The manifest records a hash of every row and of the mapping file.
+    On the next run, rows whose hash is unchanged are skipped as long as
+    the mapping file and the requested outputs are unchanged too, and
+    the folder still holds its output files.  Folders that no row
+    produces anymore are reported as removed.
+    """
+
+    version = 1
+
+    def __init__(self, path, mappingHash, outputs):
+        self.path = path
+        self.mappingHash = mappingHash
+        self.outputs = outputs
+        self.previousFolders = {}
+        self.reusable = False
+        if os.path.exists(path):
+            with open(path) as manifestFile:
+                previous = json.load(manifestFile)
+            self.previousFolders = previous.get('folders', {})
+            self.reusable = (previous.get('version') == self.version and
+                             previous.get('mappingHash') == mappingHash and
+                             previous.get('outputs') == outputs)
+        self._previousByHash = {}
+        if self.reusable:
+            for folder, rowHash in self.previousFolders.items():
+                self._previousByHash[rowHash] = folder
+        self._pending = {}
+        self.folders = {}
+        self.added = []
+        self.changed = []
+        self.unchanged = 0
+
+    def filterRows(self, numberedRows):
+        """Yield only the (rowNumber, row) pairs that need rebuilding."""
+        for rowNumber, row in numberedRows:
+            rowHash = hashRow(row)
+            folder = self._previousByHash.get(rowHash)
+            if folder is not None and self.outputsExist(folder):
+                self.folders[folder] = rowHash
+                self.unchanged += 1
+                continue
+            self._pending[rowNumber] = rowHash
+            yield rowNumber, row
+
+    def outputsExist(self, folder):
+        """Return whether the files the outputs write are all still in folder."""
+        filenames = []
+        if self.outputs.get('write'):
+            filenames.append('metadata.xml')
+        if self.outputs.get('writeJSON'):
+            filenames.append('metadata.json')
+        return all(os.path.isfile(os.path.join(folder, filename)) for filename in filenames)
+
+    def recordBuilt(self, rowNumber, folder):
+        """Note that a row was rebuilt into folder."""
+        rowHash = self._pending.pop(rowNumber)
+        if folder is None:
+            return
+        if folder in self.previousFolders:
+            self.changed.append(folder)
+        else:
+            self.added.append(folder)
+        self.folders[folder] = rowHash
+
+    @property
+    def removed(self):
+        return sorted(set(self.previousFolders) - set(self.folders))
+
+    def save(self):
+        tempPath = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tempPath, 'w') as manifestFile:
+            json.dump({'version': self.version,
+                       'mappingHash': self.mappingHash,
+                       'outputs': self.outputs,
+                       'folders': self.folders},
+                      manifestFile, sort_keys=True, indent=1)
+        os.replace(tempPath, self.path)
+
+    def summary(self):
+        lines = ['%s added, %s changed, %s removed, %s unchanged'
+                 % (len(self.added), len(self.changed), len(self.removed), self.unchanged)]
+        lines.extend('added %s' % folder for folder in self.added)
+        lines.extend('changed %s' % folder for folder in self.changed)
+        lines.extend('removed %s' % folder for folder in self.removed)
+        return '\n'.join(lines)
+
+
+class RejectsWriter(object):
+    """Writes the rows that failed to convert to a CSV file.
+
+    Each row keeps its original columns, followed by m2m_row and
+    m2m_error columns, so the file can be fixed up and converted again.
+    The file is only created once a row is rejected.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def reject(self, rowNumber, row, error):
+        if self._writer is None:
+            exists = self.append and os.path.exists(self.path)
+            self._file = open(self.path, 'a' if exists else 'w', newline='', encoding='utf-8')
+            fieldnames = [name for name in row if name is not None] + ['m2m_row', 'm2m_error']
+            self._writer = csv.DictWriter(self._file, fieldnames, extrasaction='ignore')
+            if not exists:
+                self._writer.writeheader()
+        values = dict(row)
+        values['m2m_row'] = rowNumber
+        values['m2m_error'] = error
+        self._writer.writerow(values)
+        self.count += 1
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Checkpoint(object):
+    """Remembers the last row whose output was committed, for --resume.
+
+    Rows finish in order, so every row up to lastRow is done.  The
+    outputs passed to rowDone are flushed before each save, so a saved
+    checkpoint never covers rows that are still waiting to be written.
+    A running hash of the rows up to lastRow is saved too, so resuming
+    on a file whose done rows have changed, such as a new export at
+    the same path, is refused.  Rows after lastRow may change.
+    """
+
+    version = 2
+
+    def __init__(self, path, CSVPath, mappingHash, interval=1000):
+        self.path = path
+        self.CSVPath = CSVPath
+        self.mappingHash = mappingHash
+        self.interval = interval
+        self.lastRow = None
+        self.rowsHash = hashlib.sha256().hexdigest()
+        self._digest = hashlib.sha256()
+        self._doneDigest = None
+        self._pending = deque()
+        self._unsaved = 0
+        if os.path.exists(path):
+            with open(path) as checkpointFile:
+                previous = json.load(checkpointFile)
+            if (previous.get('version') != self.version or
+                    previous.get('csv') != CSVPath or
+                    previous.get('mappingHash') != mappingHash):
+                raise MetadataConverterException(
+                    'Checkpoint %s was written for a different CSV or mapping file' % path)
+            self.lastRow = previous['lastRow']
+            self.rowsHash = previous['rowsHash']
+
+    def resumeRows(self, rows):
+        """Check the done rows of rows and return (rowNumber, row) pairs for the rest.
+
+        rows are all the rows of the CSV, from the first.
+        """
+        rows = iter(rows)
+        for row in islice(rows, self.firstRow):
+            self._digest.update(hashRow(row).encode())
+        if self._digest.hexdigest() != self.rowsHash:
+            raise MetadataConverterException(
+                'Rows 0 to %s of %s have changed since checkpoint %s was saved'
+                % (self.lastRow, self.CSVPath, self.path))
+        return self._hashRows(rows)
+
+    def _hashRows(self, rows):
+        for rowNumber, row in enumerate(rows, self.firstRow):
+            self._digest.update(hashRow(row).encode())
+            self._pending.append((rowNumber, self._digest.copy()))
+            yield rowNumber, row
+
+    @property
+    def firstRow(self):
+        """The number of the first row that still needs converting."""
+        return 0 if self.lastRow is None else self.lastRow + 1
+
+    def rowDone(self, rowNumber, *outputs):
+        self.lastRow = rowNumber
+        while self._pending:
+            pendingRow, self._doneDigest = self._pending.popleft()
+            if pendingRow == rowNumber:
+                break
+        self._unsaved += 1
+        if self._unsaved >= self.interval:
+            self.save(*outputs)
+
+    def save(self, *outputs):
+        for output in outputs:
+            if output is not None:
+                output.flush()
+        if self._doneDigest is not None:
+            self.rowsHash = self._doneDigest.hexdigest()
+        tempPath = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tempPath, 'w') as checkpointFile:
+            json.dump({'version': self.version,
+                       'csv': self.CSVPath,
+                       'mappingHash': self.mappingHash,
+                       'lastRow': self.lastRow,
+                       'rowsHash': self.rowsHash},
+                      checkpointFile, sort_keys=True, indent=1)
+        os.replace(tempPath, self.path)
+        self._unsaved = 0
+
+
+class ShardManifest(object):
+    """Records the rows one --shard run converted, and the folder of each.
+
+    Manifests from every shard are checked together by mergeShards.
+    """
+
+    version = 1
+
+    def __init__(self, path, CSVHash, mappingHash, shard, shards):
+        self.path = path
+        self.CSVHash = CSVHash
+        self.mappingHash = mappingHash
+        self.shard = shard
+        self.shards = shards
+        self.rows = []
+
+    def rowDone(self, rowNumber, folder):
+        self.rows.append([rowNumber, folder])
+
+    def save(self):
+        tempPath = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tempPath, 'w') as manifestFile:
+            json.dump({'version': self.version,
+                       'csvHash': self.CSVHash,
+                       'mappingHash': self.mappingHash,
+                       'shard': self.shard,
+                       'shards': self.shards,
+                       'rows': self.rows},
+                      manifestFile, sort_keys=True)
+        os.replace(tempPath, self.path)
+
+
+def mergeShards(manifestPaths, CSVPath, mappingPath):
+    """Check that a set of shard manifests converted every row exactly once.
+
+    Returns a list of problems, which is empty when the shards are for
+    this CSV and mapping file, every shard is present once, every row
+    was converted by exactly one shard and no two rows share a folder.
+    """
+    problems = []
+    CSVHash = hashFile(CSVPath)
+    mappingHash = hashFile(mappingPath)
+    manifests = []
+    for path in manifestPaths:
+        with open(path) as manifestFile:
+            manifest = json.load(manifestFile)
+        if manifest.get('version') != ShardManifest.version:
+            problems.append('%s is not a shard manifest' % path)
+        elif manifest['csvHash'] != CSVHash:
+            problems.append('%s was written for a different CSV file' % path)
+        elif manifest['mappingHash'] != mappingHash:
+            problems.append('%s was written with a different mapping file' % path)
+        else:
+            manifests.append(manifest)
+    if problems:
+        return problems
+
+    shardCounts = {}
+    for manifest in manifests:
+        key = (manifest['shard'], manifest['shards'])
+        shardCounts[key] = shardCounts.get(key, 0) + 1
+    shards = {manifest['shards'] for manifest in manifests}
+    if len(shards) > 1:
+        problems.append('Manifests split the CSV into different numbers of shards: %s'
+                        % ', '.join(str(n) for n in sorted(shards)))
+    for shard, shardCount in sorted(shardCounts.items()):
+        if shardCount > 1:
+            problems.append('Shard %s/%s appears %s times' % (shard + (shardCount,)))
+    for n in shards:
+        for shard in range(1, n + 1):
+            if (shard, n) not in shardCounts:
+                problems.append('Shard %s/%s is missing' % (shard, n))
+
+    converted = {}
+    folders = {}
+    for manifest in manifests:
+        for rowNumber, folder in manifest['rows']:
+            converted[rowNumber] = converted.get(rowNumber, 0) + 1
+            if folder is not None:
+                folders.setdefault(folder, []).append(rowNumber)
+    rowCount = countCSVRows(CSVPath)
+    missing = [n for n in range(rowCount) if n not in converted]
+    if missing:
+        problems.append('%s rows were not converted: %s' % (len(missing), summarizeRows(missing)))
+    repeated = sorted(n for n, count in converted.items() if count > 1)
+    if repeated:
+        problems.append('%s rows were converted more than once: %s'
+                        % (len(repeated), summarizeRows(repeated)))
+    failed = sorted({n for manifest in manifests for n, folder in manifest['rows']
+                     if folder is None})
+    if failed:
+        problems.append('%s rows failed: %s' % (len(failed), summarizeRows(failed)))
+    for folder, rowNumbers in sorted(folders.items()):
+        if len(rowNumbers) > 1:
+            problems.append('Folder %s was written by rows %s'
+                            % (folder, ', '.join(str(n) for n in sorted(rowNumbers))))
+    return problems
+
+
+def summarizeRows(rowNumbers, limit=10):
+    shown = ', '.join(str(n) for n in rowNumbers[:limit])
+    if len(rowNumbers) > limit:
+        shown += ', ...'
+    return shown
+
+
+class RunStats(object):
+    """Timers and counters for the stages of a conversion run.
+
+    Stage times cover reading CSV rows (parse), running the mapping
+    (map), serializing records (serialize) and writing files (write).
+    Mapping calls are also timed per element and qualifier.
+    """
+
+    stages = ('parse', 'map', 'serialize', 'write')
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.counts = {}
+        self.fieldSeconds = {}
+        self.fieldCalls = {}
+        self.transformCounts = {}
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def addField(self, field, seconds):
+        self.fieldSeconds[field] = self.fieldSeconds.get(field, 0.0) + seconds
+        self.fieldCalls[field] = self.fieldCalls.get(field, 0) + 1
+
+    def addTransforms(self, counts):
+        """Add {name: (hits, misses)} counts for memoized transforms."""
+        for name, (hits, misses) in counts.items():
+            total = self.transformCounts.setdefault(name, [0, 0])
+            total[0] += hits
+            total[1] += misses
+
+    def asDict(self):
+        return {'seconds': self.seconds, 'counts': self.counts,
+                'fieldSeconds': self.fieldSeconds, 'fieldCalls': self.fieldCalls,
+                'transformCounts': self.transformCounts}
+
+    def merge(self, data):
+        """Add in the asDict() output of another RunStats."""
+        for stage, seconds in data['seconds'].items():
+            self.add(stage, seconds)
+        for name, n in data['counts'].items():
+            self.count(name, n)
+        for field, seconds in data['fieldSeconds'].items():
+            self.fieldSeconds[field] = self.fieldSeconds.get(field, 0.0) + seconds
+        for field, calls in data['fieldCalls'].items():
+            self.fieldCalls[field] = self.fieldCalls.get(field, 0) + calls
+        self.addTransforms(data['transformCounts'])
+
+    def drain(self):
+        """Return asDict() and reset all timers and counters."""
+        data = self.asDict()
+        self.__init__()
+        return data
+
+    def summary(self, elapsed):
+        lines = ['Stage times (%.3fs elapsed):' % elapsed]
+        for stage in self.stages:
+            lines.append('  %-10s %10.3fs' % (stage, self.seconds[stage]))
+        if self.counts:
+            lines.append('Counters:')
+            for name in sorted(self.counts):
+                lines.append('  %-10s %10s' % (name, self.counts[name]))
+        if self.fieldSeconds:
+            lines.append('Mapping fields:')
+            fields = sorted(self.fieldSeconds, key=self.fieldSeconds.get, reverse=True)
+            for field in fields:
+                lines.append('  %-30s %10.3fs %10s calls'
+                             % (field, self.fieldSeconds[field], self.fieldCalls[field]))
+        if self.transformCounts:
+            lines.append('Memoized transforms:')
+            for name in sorted(self.transformCounts):
+                hits, misses = self.transformCounts[name]
+                rate = 100.0 * hits / (hits + misses) if hits + misses else 0.0
+                lines.append('  %-30s %10s hits %10s misses %5.1f%% hit rate'
+                             % (name, hits, misses, rate))
+        return '\n'.join(lines)
+
+
+def instrumentedRecordClass(stats, RecordClass=None):
+    """Return a subclass of RecordClass that reports timings to stats."""
+    RecordClass = RecordClass or MetadataRecord
+
+    class InstrumentedRecord(RecordClass):
+
+        def mapping(self, elementType, elementName, elementValue, qualifier=None, **kwargs):
+            started = time.perf_counter()
+            try:
+                return super().mapping(elementType, elementName, elementValue,
+                                       qualifier=qualifier, **kwargs)
+            finally:
+                stats.addField('%s/%s' % (elementName, qualifier or ''),
+                               time.perf_counter() - started)
+
+        def applyField(self, field, elementValue):
+            started = time.perf_counter()
+            try:
+                return super().applyField(field, elementValue)
+            finally:
+                stats.addField('%s/%s' % (field.elementName, field.qualifier or ''),
+                               time.perf_counter() - started)
+
+        def applyPreparedField(self, field, valueList):
+            started = time.perf_counter()
+            try:
+                return super().applyPreparedField(field, valueList)
+            finally:
+                stats.addField('%s/%s' % (field.elementName, field.qualifier or ''),
+                               time.perf_counter() - started)
+
+        def __bytes__(self):
+            started = time.perf_counter()
+            try:
+                return super().__bytes__()
+            finally:
+                stats.add('serialize', time.perf_counter() - started)
+
+    return InstrumentedRecord
+
+
+class TimedWriter(object):
+    """Wraps a writer and reports write times and sizes to stats."""
+
+    def __init__(self, writer, stats):
+        self.writer = writer
+        self.stats = stats
+
+    def writeFile(self, baseDirectory, foldername, filename, data):
+        started = time.perf_counter()
+        self.writer.writeFile(baseDirectory, foldername, filename, data)
+        self.stats.add('write', time.perf_counter() - started)
+        self.stats.count('files')
+        self.stats.count('bytes', len(data))
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+def timedRows(numberedRows, stats):
+    """Pass (rowNumber, row) pairs through, timing how long each takes to read."""
+    iterator = iter(numberedRows)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stats.add('parse', time.perf_counter() - started)
+            return
+        stats.add('parse', time.perf_counter() - started)
+        yield item
+
+
+def readAhead(iterable, maxPending=64):
+    """Iterate over iterable on a background thread, up to maxPending items ahead."""
+    items = queue.Queue(maxPending)
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except BaseException as e:
+            put((False, e))
+        else:
+            put((False, None))
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class ProgressReporter(object):
+    """Prints a progress line with rows/sec and ETA every few seconds.
+
+    The ETA is estimated from how much of the input file has been read,
+    counted in characters, so it is approximate for non-ASCII input.
+    """
+
+    def __init__(self, totalSize=None, interval=5.0, stream=None):
+        self.totalSize = totalSize
+        self.interval = interval
+        self.stream = stream
+        self.consumed = 0
+        self.rows = 0
+        self.started = self.lastReport = time.monotonic()
+
+    def countLines(self, lines):
+        for line in lines:
+            self.consumed += len(line)
+            yield line
+
+    def update(self, rows=1):
+        self.rows += rows
+        now = time.monotonic()
+        if self.interval and now - self.lastReport >= self.interval:
+            self.lastReport = now
+            self.report(now)
+
+    def report(self, now=None):
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.started
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        line = 'Processed %s rows (%.1f rows/sec)' % (self.rows, rate)
+        if self.totalSize and self.consumed:
+            fraction = min(self.consumed / self.totalSize, 1.0)
+            remaining = elapsed * (1 - fraction) / fraction
+            line += ', about %d%% done, ETA %s' % (
+                fraction * 100, time.strftime('%H:%M:%S', time.gmtime(remaining)))
+        print(line, file=self.stream or sys.stderr)
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        print('Processed %s rows in %.1fs (%.1f rows/sec)' % (self.rows, elapsed, rate),
+              file=self.stream or sys.stderr)
+
+
+def driverRecordClass(stats=None, nodeCacheSize=0, compact=False, creationDate=None):
+    """Return the record class the command line driver builds records with."""
+    recordClass = CompactRecord if compact else MetadataRecord
+    if creationDate is not None:
+        recordClass = contextRecordClass(RecordContext(creationDate), recordClass)
+    if nodeCacheSize:
+        recordClass = cachedRecordClass(NodeCache(nodeCacheSize, stats=stats), recordClass)
+    if stats is not None:
+        recordClass = instrumentedRecordClass(stats, recordClass)
+    return recordClass
+
+
+def recordFolder(record):
+    """Return the output folder a record is written to, if it has one."""
+    baseDirectory = getattr(record, 'baseDirectory', None)
+    foldername = getattr(record, 'foldername', None)
+    if baseDirectory is None or foldername is None:
+        return None
+    return os.path.join(baseDirectory, foldername)
+
+
+def convertRows(numberedRows, mappingFunction, recordClass=None, stats=None, onError=None,
+                **outputs):
+    """Build and emit (rowNumber, row) pairs one at a time.
+
+    outputs are passed on to emitRecord.  Yields (rowNumber, folder) as
+    each row finishes, with no folder for rows skipped by a FolderIndex.
+    If onError is given, a row that fails is passed to onError(rowNumber,
+    row, error) and yielded with no folder instead of stopping the run.
+    """
+    recordClass = recordClass or MetadataRecord
+    for rowNumber, row in numberedRows:
+        try:
+            # Build each record once and hand it to every output.
+            if stats is None:
+                record = mappingFunction(recordClass, row)
+            else:
+                started = time.perf_counter()
+                record = mappingFunction(recordClass, row)
+                stats.add('map', time.perf_counter() - started)
+                stats.count('rows')
+            emitted = emitRecord(record, row, rowNumber, **outputs)
+        except Exception as e:
+            if onError is None:
+                raise
+            onError(rowNumber, row, '%s: %s' % (type(e).__name__, e))
+            yield rowNumber, None
+        else:
+            yield rowNumber, recordFolder(record) if emitted else None
+
+
+def convertRowsPipelined(numberedRows, mappingFunction, writerThread, recordClass=None,
+                         stats=None, onError=None, maxPending=64, **outputs):
+    """Convert rows like convertRows, overlapping reading, mapping and writing.
+
+    Rows are read ahead on a background thread, records are built and
+    serialized on this one, and their files are written through
+    writerThread, a WriterThread.  Both queues between the stages are
+    bounded by maxPending, so a slow stage holds back the ones before
+    it.  Yields (rowNumber, folder) in row order once a row's files
+    have been written.  A row whose files fail to write is passed to
+    onError, if given, like a row that fails to convert.
+    """
+    # Rows waiting for their files, to hand to onError if a write fails.
+    pendingRows = deque()
+
+    def remember(numberedRows):
+        for rowNumber, row in numberedRows:
+            pendingRows.append(row)
+            yield rowNumber, row
+
+    def finished():
+        for rowNumber, folder, error in writerThread.completed():
+            row = pendingRows.popleft()
+            if error is not None:
+                if onError is None:
+                    raise error
+                onError(rowNumber, row, '%s: %s' % (type(error).__name__, error))
+                folder = None
+            yield rowNumber, folder
+
+    converted = convertRows(remember(readAhead(numberedRows, maxPending)), mappingFunction,
+                            recordClass=recordClass, stats=stats, onError=onError,
+                            writer=writerThread, **outputs)
+    for rowNumber, folder in converted:
+        writerThread.rowDone(rowNumber, folder)
+        yield from finished()
+    writerThread.flush()
+    yield from finished()
+
+
+def validateRows(numberedRows, mappingFunction, recordClass=None):
+    """Run every (rowNumber, row) pair through the mapping and collect errors.
+
+    Returns the number of rows checked and a list of (rowNumber, error)
+    pairs for the rows that failed.
+    """
+    recordClass = recordClass or ValidatingRecord
+    rowCount = 0
+    errors = []
+    for rowNumber, row in numberedRows:
+        rowCount += 1
+        try:
+            mappingFunction(recordClass, row)
+        except Exception as e:
+            errors.append((rowNumber, '%s: %s' % (type(e).__name__, e)))
+    return rowCount, errors
+
+
+def serveRows(requests, responses, index, mappingFunction, recordClass=None, writer=None,
+              write=False, writeJSON=False):
+    """Convert the rows whose numbers are read from requests, one per line.
+
+    The mapping, record class and CSV index stay loaded between requests.
+    Each request is answered with one line on responses: the record as
+    a --jsonl-untl line, or {"error": ...} if the row can't be converted.
+    Files for write and writeJSON are flushed before the answer is sent.
+    """
+    recordClass = recordClass or MetadataRecord
+    writer = writer or defaultOutputWriter
+    formatter = JSONLinesWriter(responses, includeUNTL=True)
+    for request in requests:
+        request = request.strip()
+        if not request:
+            continue
+        try:
+            index.refresh()
+            row = index.row(int(request))
+            if row is None:
+                raise MetadataConverterException('%s is not a valid row number' % request)
+            record = mappingFunction(recordClass, row)
+            if write or writeJSON:
+                emitRecord(record, row, request, write=write, writeJSON=writeJSON,
+                           writer=writer, verbose=False)
+                writer.flush()
+            response = formatter.formatRecord(record, row)
+        except Exception as e:
+            response = json.dumps({'error': '%s: %s' % (type(e).__name__, e)},
+                                  ensure_ascii=False)
+        responses.write(response + '\n')
+        responses.flush()
+
+
+# Per-process state for the --jobs worker pool.
+_workerState = {}
+
+
+def _initWorker(mappingPath, workerOptions):
+    import multiprocessing.util
+    writerOptions = workerOptions['writerOptions']
+    if writerOptions is None:
+        # The parent owns the output, so files are sent back to it.
+        writer = None
+    else:
+        writer = OutputWriter(**writerOptions)
+        # Flush queued writes when the worker exits after pool.close().
+        multiprocessing.util.Finalize(writer, writer.close, exitpriority=10)
+    multiprocessing.util.Finalize(transformRegistry, transformRegistry.close, exitpriority=10)
+    stats = RunStats() if workerOptions['stats'] else None
+    if mappingPath is None:
+        _workerState['mappingFunction'] = batchMappingFunction
+    else:
+        _workerState['mappingFunction'] = loadMappingFunction(mappingPath)
+    _workerState['options'] = workerOptions
+    _workerState['writer'] = writer
+    _workerState['stats'] = stats
+    _workerState['recordClass'] = driverRecordClass(stats, workerOptions['nodeCacheSize'],
+                                                    workerOptions['compact'],
+                                                    workerOptions['creationDate'])
+
+
+def _convertRow(task):
+    """Build and emit one row inside a worker process.
+
+    Only the record's folder, the captured progress output and any
+    error text are sent back to the parent, along with files and JSON
+    lines for outputs that the parent owns and any stage timings.
+    """
+    rowNumber, row = task
+    options = _workerState['options']
+    stats = _workerState['stats']
+    stream = io.StringIO()
+    writer = _workerState['writer'] or CollectingWriter()
+    if stats is not None:
+        writer = TimedWriter(writer, stats)
+    jsonLines = None
+    if options['jsonLinesOptions'] is not None:
+        jsonLines = JSONLinesWriter(io.StringIO(), **options['jsonLinesOptions'])
+    result = {'rowNumber': rowNumber, 'folder': None, 'error': None,
+              'files': [], 'lines': ''}
+    try:
+        _, result['folder'] = next(convertRows(
+            [task], _workerState['mappingFunction'], recordClass=_workerState['recordClass'],
+            stats=stats, stream=stream, writer=writer, jsonLines=jsonLines,
+            **options['outputs']))
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['row'] = row
+    else:
+        if options['returnRows']:
+            result['row'] = row
+        if options['flushRows'] and _workerState['writer'] is not None:
+            # The parent checkpoints rows as soon as they come back.
+            _workerState['writer'].flush()
+        if isinstance(writer, TimedWriter):
+            writer = writer.writer
+        if isinstance(writer, CollectingWriter):
+            result['files'] = writer.files
+        if jsonLines is not None:
+            result['lines'] = jsonLines.stream.getvalue()
+    result['output'] = stream.getvalue()
+    if stats is not None:
+        stats.addTransforms(transformRegistry.drainCounts())
+        result['stats'] = stats.drain()
+    return result
+
+
+def _boundedTasks(numberedRows, slots, stopped):
+    # Pool.imap reads its input from a feeder thread as fast as it can,
+    # so hold it back to a bounded number of rows in flight.  The pool
+    # joins that thread when it is terminated, so it must not wait for
+    # a slot once stopped is set.
+    for task in numberedRows:
+        while not slots.acquire(timeout=0.1):
+            if stopped.is_set():
+                return
+        if stopped.is_set():
+            return
+        yield task
+
+
+def convertRowsInParallel(numberedRows, mappingPath, jobs, write=False, writeJSON=False,
+                          writerOptions=None, writer=None, jsonLines=None, stats=None,
+                          nodeCacheSize=0, compact=False, creationDate=None, verbose=True,
+                          onError=None, flushRows=False, folders=None, chunksize=16):
+    """Spread (rowNumber, row) pairs across a pool of worker processes.
+
+    Each worker compiles the mapping once and writes its own files
+    through an OutputWriter built from writerOptions.  If writer is
+    given instead (for outputs such as an archive that only one process
+    can own), workers send their files back and the parent writes them.
+    Lines for jsonLines are likewise written by the parent, and worker
+    timings are merged into stats.  Each worker keeps its own node cache
+    of nodeCacheSize elements, builds CompactRecords if compact is set
+    and gives every record creationDate, if set, as driverRecordClass
+    does.  Yields (rowNumber, folder) in row order, printing each row's
+    progress as it goes, and stops at the first row that fails unless
+    onError is given, as for convertRows.  With flushRows, workers
+    flush their writers after every row.  Folders are claimed from the
+    FolderIndex folders, if given, by the parent in row order before it
+    writes their files, so writer is needed with it.
+    """
+    workerOptions = {
+        'outputs': {'write': write, 'writeJSON': writeJSON, 'verbose': verbose},
+        'writerOptions': (writerOptions or {}) if writer is None else None,
+        'jsonLinesOptions': None,
+        'stats': stats is not None,
+        'nodeCacheSize': nodeCacheSize,
+        'compact': compact,
+        'creationDate': creationDate,
+        'flushRows': flushRows,
+        'returnRows': folders is not None,
+    }
+    if jsonLines is not None:
+        workerOptions['jsonLinesOptions'] = {'includeUNTL': jsonLines.includeUNTL}
+    import multiprocessing
+    slots = threading.Semaphore(chunksize * jobs * 4)
+    stopped = threading.Event()
+    pool = multiprocessing.Pool(jobs, initializer=_initWorker,
+                                initargs=(mappingPath, workerOptions))
+    try:
+        results = pool.imap(_convertRow, _boundedTasks(numberedRows, slots, stopped),
+                            chunksize)
+        for result in results:
+            slots.release()
+            sys.stdout.write(result['output'])
+            if stats is not None:
+                stats.merge(result['stats'])
+            error, files, folder = result['error'], result['files'], result['folder']
+            if error is None and folders is not None and files:
+                baseDirectory, foldername = files[0][:2]
+                try:
+                    foldername = folders.claim(result['rowNumber'], baseDirectory, foldername)
+                except MetadataConverterException as e:
+                    error = '%s: %s' % (type(e).__name__, e)
+                else:
+                    if foldername is None:
+                        files, folder = [], None
+                    else:
+                        files = [(baseDirectory, foldername) + fileArgs[2:] for fileArgs in files]
+                        folder = os.path.join(baseDirectory, foldername)
+            if error is not None:
+                if onError is None:
+                    raise MetadataConverterException(
+                        'Error processing row %s: %s' % (result['rowNumber'], error))
+                onError(result['rowNumber'], result['row'], error)
+                yield result['rowNumber'], None
+                continue
+            for fileArgs in files:
+                writer.writeFile(*fileArgs)
+            if result['lines']:
+                jsonLines.stream.write(result['lines'])
+            yield result['rowNumber'], folder
+        # Let the workers exit normally so their writers get flushed.
+        pool.close()
+    except BaseException:
+        stopped.set()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def shardArgument(value):
+    """Parse a --shard value of the form K/N."""
+    try:
+        shard, shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ArgumentTypeError('shard must look like K/N, for example 2/8')
+    if not 1 <= shard <= shards:
+        raise ArgumentTypeError('shard K/N needs 1 <= K <= N')
+    return shard, shards
+
+
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument('csv_file', nargs='*',
+                        help='Specify the CSV files or glob patterns to process.')
+    parser.add_argument('-m', '--mapping',
+                        help='Specify the mapping file to use for these CSVs')
+    parser.add_argument('--reader', choices=list(READERS),
+                        dest='reader',
+                        help='Read the input files as csv, tsv, jsonl or sqlite (default: '
+                             'by file extension, else csv)')
+    parser.add_argument('--query', metavar='SQL',
+                        dest='query',
+                        help='Query that selects the rows of a SQLite input (default: '
+                             'every row of its only table)')
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        dest='batch',
+                        help='Also convert the CSV files listed in MANIFEST, a CSV file '
+                             'with csv and mapping columns')
+    parser.add_argument('-n', '--row', type=int,
+                        dest='row',
+                        help='Specify a single row number to process')
+    parser.add_argument('-w', '--write', action='store_true',
+                        dest='write',
+                        help='Write records to files')
+    parser.add_argument('-j', '--json', action='store_true',
+                        dest='json',
+                        help='Write json version of metadata')
+    parser.add_argument('--jobs', type=int, default=1,
+                        dest='jobs',
+                        help='Number of worker processes to convert rows with')
+    parser.add_argument('--pipeline', action='store_true',
+                        dest='pipeline',
+                        help='Read rows and write files on background threads while '
+                             'records are built')
+    parser.add_argument('--write-threads', type=int, default=0,
+                        dest='write_threads',
+                        help='Write files from this many background threads')
+    parser.add_argument('--atomic', action='store_true',
+                        dest='atomic',
+                        help='Write files to a temporary name and rename them into place')
+    parser.add_argument('--fsync-batch', type=int, default=0,
+                        dest='fsync_batch',
+                        help='fsync written files in batches of this size')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        dest='skip_unchanged',
+                        help='Leave files alone that already hold the same content')
+    parser.add_argument('--on-collision', choices=FolderIndex.policies,
+                        dest='on_collision',
+                        help='When two rows have the same folder, warn and overwrite, stop '
+                             'with an error, skip the later row or add a -2 suffix')
+    parser.add_argument('--incremental', metavar='MANIFEST',
+                        dest='incremental',
+                        help='Only rebuild rows that changed since the run that wrote MANIFEST')
+    parser.add_argument('--archive', metavar='PATH',
+                        dest='archive',
+                        help='Write all record files into one tar or zip archive at PATH')
+    parser.add_argument('--jsonl', metavar='PATH',
+                        dest='jsonl',
+                        help='Stream one compact JSON line per record to PATH (- for stdout)')
+    parser.add_argument('--jsonl-untl', action='store_true',
+                        dest='jsonl_untl',
+                        help='Include the serialized UNTL record in each JSON line')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest='verbose',
+                        help='Print a line for every file written')
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        dest='progress_interval',
+                        help='Seconds between progress lines on stderr (0 to disable)')
+    parser.add_argument('--stats', action='store_true',
+                        dest='stats',
+                        help='Print per-stage and per-field timings when done')
+    parser.add_argument('--profile', metavar='PATH',
+                        dest='profile',
+                        help='Write cProfile data for the main process to PATH')
+    parser.add_argument('--node-cache', type=int, default=0, metavar='SIZE',
+                        dest='node_cache',
+                        help='Share up to SIZE prebuilt elements for values that repeat '
+                             'across rows')
+    parser.add_argument('--continue-on-error', action='store_true',
+                        dest='continue_on_error',
+                        help='Write rows that fail to a rejects CSV and keep going')
+    parser.add_argument('--rejects', metavar='PATH',
+                        dest='rejects',
+                        help='CSV file for rejected rows (default: rejects.csv)')
+    parser.add_argument('--resume', metavar='CHECKPOINT',
+                        dest='resume',
+                        help='Save progress to CHECKPOINT and, if it exists, start after '
+                             'the last row it records')
+    parser.add_argument('--index', metavar='PATH',
+                        dest='index',
+                        help='Keep the byte offset of every row in PATH, so --row and '
+                             '--serve read rows directly')
+    parser.add_argument('--serve', action='store_true',
+                        dest='serve',
+                        help='Keep running, reading row numbers from stdin and answering '
+                             'each with one JSON line on stdout')
+    parser.add_argument('--shard', type=shardArgument, metavar='K/N',
+                        dest='shard',
+                        help='Only convert every Nth row, starting with row K-1, and list '
+                             'them in a shard manifest')
+    parser.add_argument('--shard-manifest', metavar='PATH',
+                        dest='shard_manifest',
+                        help='Where --shard lists its rows (default: shard-K-of-N.json)')
+    parser.add_argument('--merge-shards', action='append', metavar='MANIFEST',
+                        dest='merge_shards',
+                        help='Check that the shard manifests converted every row of the '
+                             'CSV exactly once, instead of converting it.  Give one '
+                             'manifest or quoted glob pattern per --merge-shards')
+    parser.add_argument('--validate', action='store_true',
+                        dest='validate',
+                        help='Check every row before converting any, and stop if one fails')
+    parser.add_argument('--validate-only', action='store_true',
+                        dest='validate_only',
+                        help='Only check every row and report all errors')
+    parser.add_argument('--compact', action='store_true',
+                        dest='compact',
+                        help='Keep mapped elements as tuples and only build a pyuntl tree '
+                             'for mapping files that use root_element')
+    parser.add_argument('--creation-date', metavar='DATE',
+                        dest='creation_date',
+                        help='Give every record of the run this metadataCreationDate, as '
+                             '"YYYY-MM-DD, HH:MM:SS", or "run" for the time the run '
+                             'started (default: the time each record is built)')
+    parser.add_argument('--columnar', action='store_true',
+                        dest='columnar',
+                        help='Clean the columns of a MAPPING spec a chunk of rows at a '
+                             'time before building records')
+    parser.add_argument('--columnar-backend', choices=list(COLUMNAR_BACKENDS),
+                        dest='columnar_backend',
+                        help='Use pyarrow, numpy or python for --columnar (default: '
+                             'the fastest installed)')
+    args = parser.parse_args(argv)
+
+    if args.csv_file and not args.mapping:
+        sys.exit('--mapping is required for CSV files given on the command line.')
+    try:
+        args.inputs = batchInputs(args.csv_file, args.mapping, args.batch)
+    except MetadataConverterException as e:
+        sys.exit(str(e))
+    if not args.inputs:
+        sys.exit('No CSV files given.')
+    if args.merge_shards and len(args.inputs) > 1:
+        sys.exit('--merge-shards takes one manifest, or a quoted pattern such as '
+                 '"shard-*.json", each time it is given, and one CSV file.')
+    if len(args.inputs) == 1:
+        args.csv_file, args.mapping = args.inputs[0]
+    elif (args.row or args.index or args.serve or args.resume or args.incremental or
+          args.shard or args.merge_shards or args.columnar):
+        sys.exit('--row, --index, --serve, --resume, --incremental, --shard, '
+                 '--merge-shards and --columnar only support one CSV file.')
+    readers = {readerName(CSVFile, args.reader) for CSVFile, mappingFile in args.inputs}
+    if args.query and readers != {'sqlite'}:
+        sys.exit('--query requires SQLite input files.')
+    if readers != {'csv'} and (args.shard or args.index or args.serve or args.merge_shards):
+        sys.exit('--shard, --index, --serve and --merge-shards only support CSV files.')
+
+    if args.jobs < 1:
+        sys.exit('jobs must be a positive integer.')
+    if args.pipeline and args.jobs > 1:
+        sys.exit('--pipeline cannot be combined with --jobs.')
+    if args.node_cache < 0:
+        sys.exit('node-cache must not be negative.')
+    if args.compact and args.node_cache:
+        sys.exit('--compact cannot be combined with --node-cache.')
+    if args.creation_date == 'run':
+        args.creation_date = RecordContext.fixed().creationDate
+    elif args.creation_date is not None:
+        try:
+            time.strptime(args.creation_date, CREATION_DATE_FORMAT)
+        except ValueError:
+            sys.exit('--creation-date must look like "2020-01-31, 09:30:00" or be run.')
+    if args.columnar_backend and not args.columnar:
+        sys.exit('--columnar-backend requires --columnar.')
+    if args.columnar_backend and args.columnar_backend not in columnarBackends():
+        sys.exit('--columnar-backend %s is not installed.' % args.columnar_backend)
+    if args.incremental and not (args.write or args.json):
+        sys.exit('--incremental requires --write or --json.')
+    if args.skip_unchanged and not (args.write or args.json):
+        sys.exit('--skip-unchanged requires --write or --json.')
+    if args.skip_unchanged and args.archive:
+        sys.exit('--skip-unchanged cannot be combined with --archive.')
+    if args.on_collision and not (args.write or args.json):
+        sys.exit('--on-collision requires --write or --json.')
+    if args.on_collision and args.jobs > 1 and args.jsonl:
+        sys.exit('--on-collision cannot be combined with --jobs and --jsonl.')
+    if args.jsonl_untl and not args.jsonl:
+        sys.exit('--jsonl-untl requires --jsonl.')
+    if args.archive and not (args.write or args.json):
+        sys.exit('--archive requires --write or --json.')
+    if args.archive and args.incremental:
+        sys.exit('--archive cannot be combined with --incremental.')
+    if args.incremental and args.row:
+        sys.exit('--incremental cannot be combined with --row.')
+
+    if args.rejects and not args.continue_on_error:
+        sys.exit('--rejects requires --continue-on-error.')
+    if args.continue_on_error and not args.rejects:
+        args.rejects = 'rejects.csv'
+    if args.continue_on_error and args.write_threads:
+        # Background writes fail after their row is done, so they can't
+        # be rejected with it.
+        sys.exit('--continue-on-error cannot be combined with --write-threads.')
+    if args.resume and (args.row or args.incremental):
+        sys.exit('--resume cannot be combined with --row or --incremental.')
+    if args.resume and (args.archive or args.jsonl):
+        sys.exit('--resume cannot be combined with --archive or --jsonl.')
+
+    if args.row and args.row < 0:
+        sys.exit('row must be a positive integer.')
+    if args.shard_manifest and not args.shard:
+        sys.exit('--shard-manifest requires --shard.')
+    if args.shard and (args.row or args.resume or args.incremental):
+        sys.exit('--shard cannot be combined with --row, --resume or --incremental.')
+    if args.shard and not args.shard_manifest:
+        args.shard_manifest = 'shard-%s-of-%s.json' % args.shard
+
+    if args.serve and (args.row or args.jobs > 1 or args.shard or args.resume or
+                       args.incremental or args.archive or args.jsonl or args.pipeline or
+                       args.validate or args.validate_only or args.continue_on_error or
+                       args.on_collision):
+        sys.exit('--serve only supports the --write, --json, --index, --compact, '
+                 '--node-cache and write options.')
+    if args.serve:
+        return _serve(args)
+
+    if args.merge_shards:
+        try:
+            manifests = [path for pattern in args.merge_shards
+                         for path in globPaths(pattern, 'shard manifests')]
+        except MetadataConverterException as e:
+            sys.exit(str(e))
+        problems = mergeShards(manifests, os.path.abspath(args.csv_file),
+                               os.path.abspath(args.mapping))
+        if problems:
+            sys.exit('\n'.join(problems))
+        print('Every row of %s was converted exactly once by %s shards.'
+              % (args.csv_file, len(manifests)))
+        return
+
+    if not args.profile:
+        return _openOutputsAndRun(args)
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return _openOutputsAndRun(args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+
+def _serve(args):
+    CSVPath = os.path.abspath(args.csv_file)
+    index = CSVIndex(CSVPath, args.index and os.path.abspath(args.index))
+    writer = OutputWriter(threads=args.write_threads, atomic=args.atomic,
+                          fsyncBatch=args.fsync_batch, skipUnchanged=args.skip_unchanged)
+    try:
+        serveRows(sys.stdin, sys.stdout, index, loadMappingFunction(os.path.abspath(args.mapping)),
+                  recordClass=driverRecordClass(None, args.node_cache, args.compact,
+                                                args.creation_date),
+                  writer=writer, write=args.write, writeJSON=args.json)
+    finally:
+        writer.close()
+        transformRegistry.close()
+
+
+def _openOutputsAndRun(args):
+    if args.jsonl == '-':
+        # Keep stdout for the JSON lines and send progress to stderr.
+        jsonLinesStream = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            return _run(args, jsonLinesStream)
+    elif args.jsonl:
+        with open(args.jsonl, 'w', encoding='utf-8') as jsonLinesStream:
+            return _run(args, jsonLinesStream)
+    return _run(args, None)
+
+
+def _run(args, jsonLinesStream):
+    inputs = None
+    if len(args.inputs) > 1:
+        print('Processing %s CSV files' % len(args.inputs))
+        inputs = []
+        for CSVFile, mappingFile in args.inputs:
+            print('  %s with mapping %s' % (CSVFile, mappingFile))
+            inputs.append(BatchInput(os.path.abspath(CSVFile), os.path.abspath(mappingFile)))
+        mappingPath = CSVPath = None
+        size = sum(os.path.getsize(batchInput.CSVPath) for batchInput in inputs)
+    else:
+        print('Processing CSV file %s with mapping %s' % (args.csv_file, args.mapping))
+        mappingPath = os.path.abspath(args.mapping)
+        CSVPath = os.path.abspath(args.csv_file)
+        size = os.path.getsize(CSVPath)
+    progress = ProgressReporter(size, interval=args.progress_interval)
+    readerOptions = {'query': args.query} if args.query else {}
+    checkpoint = None
+    if args.resume:
+        try:
+            checkpoint = Checkpoint(os.path.abspath(args.resume), CSVPath, hashFile(mappingPath))
+        except MetadataConverterException as e:
+            sys.exit(str(e))
+        if checkpoint.lastRow is not None:
+            print('Resuming after row %s' % checkpoint.lastRow)
+    firstRow = 0 if checkpoint is None else checkpoint.firstRow
+    if inputs is None:
+        CSVRows = readRows(CSVPath, args.reader, progress=progress, **readerOptions)
+
+    if args.row and args.index:
+        row = CSVIndex(CSVPath, os.path.abspath(args.index)).row(args.row)
+        CSVRows = [] if row is None else [row]
+        if not CSVRows:
+            sys.exit('Sorry, %s is not a valid row number.' % args.row)
+    elif args.row:
+        CSVRows = list(islice(readRows(CSVPath, args.reader, start=args.row,
+                                       **readerOptions), 1))
+        if not CSVRows:
+            sys.exit('Sorry, %s is not a valid row number.' % args.row)
+
+    writerOptions = {'threads': args.write_threads, 'atomic': args.atomic,
+                     'fsyncBatch': args.fsync_batch, 'skipUnchanged': args.skip_unchanged}
+    outputs = {'write': args.write, 'writeJSON': args.json}
+
+    stats = RunStats() if args.stats else None
+    started = time.perf_counter()
+    if checkpoint is not None:
+        try:
+            numberedRows = checkpoint.resumeRows(CSVRows)
+        except MetadataConverterException as e:
+            sys.exit(str(e))
+    elif inputs is None:
+        numberedRows = enumerate(CSVRows)
+    else:
+        numberedRows = batchRows(inputs, progress, args.reader, **readerOptions)
+    shardManifest = None
+    if args.shard:
+        numberedRows = iterCSVShard(CSVPath, *args.shard, progress=progress)
+        shardManifest = ShardManifest(os.path.abspath(args.shard_manifest), hashFile(CSVPath),
+                                      hashFile(mappingPath), *args.shard)
+    if stats is not None:
+        numberedRows = timedRows(numberedRows, stats)
+    manifest = None
+    if args.incremental:
+        manifest = IncrementalManifest(os.path.abspath(args.incremental),
+                                       hashFile(mappingPath), outputs)
+        numberedRows = manifest.filterRows(numberedRows)
+    if inputs is None:
+        mappingFunction = loadMappingFunction(mappingPath)
+    else:
+        mappingFunction = batchMappingFunction
+    if args.validate or args.validate_only:
+        if inputs is not None:
+            rowCount, errors = 0, []
+            for batchInput in inputs:
+                inputRows, inputErrors = validateRows(
+                    enumerate(readRows(batchInput.CSVPath, args.reader, **readerOptions)),
+                    cachedMappingFunction(batchInput.mappingPath))
+                rowCount += inputRows
+                errors.extend(('%s of %s' % (rowNumber, batchInput.CSVPath), error)
+                              for rowNumber, error in inputErrors)
+        else:
+            if args.shard:
+                validated = iterCSVShard(CSVPath, *args.shard)
+            else:
+                validated = enumerate(CSVRows if args.row else
+                                      readRows(CSVPath, args.reader, **readerOptions))
+            rowCount, errors = validateRows(validated, mappingFunction)
+        for rowNumber, error in errors:
+            print('Row %s: %s' % (rowNumber, error))
+        if errors or args.validate_only:
+            transformRegistry.close()
+        if errors:
+            sys.exit('%s of %s rows failed validation.' % (len(errors), rowCount))
+        print('%s rows passed validation.' % rowCount)
+        if args.validate_only:
+            return
+    if args.columnar:
+        plan = getattr(mappingFunction, '__self__', None)
+        if not isinstance(plan, MappingPlan):
+            sys.exit('--columnar requires a mapping file with a MAPPING spec.')
+        preprocessor = ColumnarPreprocessor(plan.fields, backend=args.columnar_backend)
+        numberedRows = preprocessor.preprocessRows(numberedRows, stats)
+
+    jsonLines = None
+    if jsonLinesStream is not None:
+        jsonLines = JSONLinesWriter(jsonLinesStream, includeUNTL=args.jsonl_untl)
+
+    rejects = None
+    onError = None
+    if args.continue_on_error and inputs is not None:
+        # Rows of different CSV files have different columns, so each
+        # file gets its own rejects file.
+        taken = set()
+        inputsByCSV = {}
+        for batchInput in inputs:
+            batchInput.rejects = RejectsWriter(
+                batchRejectsPath(os.path.abspath(args.rejects), batchInput.CSVPath, taken))
+            inputsByCSV[batchInput.CSVPath] = batchInput
+
+        def rejectBatchRow(rowNumber, row, error):
+            print('Rejected row %s of %s: %s' % (rowNumber, row.CSVPath, error))
+            inputsByCSV[row.CSVPath].rejects.reject(rowNumber, row, error)
+        onError = rejectBatchRow
+    elif args.continue_on_error:
+        rejects = RejectsWriter(os.path.abspath(args.rejects), append=firstRow > 0)
+
+        def rejectRow(rowNumber, row, error):
+            print('Rejected row %s: %s' % (rowNumber, error))
+            rejects.reject(rowNumber, row, error)
+        onError = rejectRow
+
+    folders = FolderIndex(args.on_collision) if args.on_collision else None
+    writer = outputWriter = None
+    if args.archive:
+        writer = ArchiveWriter(os.path.abspath(args.archive))
+    if args.jobs > 1:
+        if writer is None and folders is not None:
+            # Folders are claimed in row order by this process, which
+            # then writes the files itself.
+            writer = outputWriter = OutputWriter(**writerOptions)
+        if writer is not None and stats is not None:
+            writer = TimedWriter(writer, stats)
+        completed = convertRowsInParallel(numberedRows, mappingPath, args.jobs,
+                                          writerOptions=writerOptions, writer=writer,
+                                          jsonLines=jsonLines, stats=stats,
+                                          nodeCacheSize=args.node_cache,
+                                          compact=args.compact,
+                                          creationDate=args.creation_date,
+                                          verbose=args.verbose, onError=onError,
+                                          flushRows=checkpoint is not None,
+                                          folders=folders, **outputs)
+    else:
+        if writer is None:
+            writer = outputWriter = OutputWriter(**writerOptions)
+        recordClass = driverRecordClass(stats, args.node_cache, args.compact,
+                                        args.creation_date)
+        if stats is not None:
+            writer = TimedWriter(writer, stats)
+        if args.pipeline:
+            writer = WriterThread(writer)
+            completed = convertRowsPipelined(numberedRows, mappingFunction, writer,
+                                             recordClass=recordClass, stats=stats,
+                                             onError=onError, jsonLines=jsonLines,
+                                             verbose=args.verbose, folders=folders,
+                                             **outputs)
+        else:
+            completed = convertRows(numberedRows, mappingFunction,
+                                    recordClass=recordClass, stats=stats, onError=onError,
+                                    writer=writer, jsonLines=jsonLines, verbose=args.verbose,
+                                    folders=folders, **outputs)
+    try:
+        for rowNumber, folder in completed:
+            progress.update()
+            if manifest is not None:
+                manifest.recordBuilt(rowNumber, folder)
+            if checkpoint is not None:
+                checkpoint.rowDone(rowNumber, writer, rejects)
+            if shardManifest is not None:
+                shardManifest.rowDone(rowNumber, folder)
+    except MetadataConverterException as e:
+        if args.jobs > 1:
+            sys.exit(str(e))
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
+        if rejects is not None:
+            rejects.close()
+        for batchInput in inputs or ():
+            if batchInput.rejects is not None:
+                batchInput.rejects.close()
+        if checkpoint is not None:
+            checkpoint.save()
+        if shardManifest is not None:
+            shardManifest.save()
+        transformRegistry.close()
+
+    if args.progress_interval:
+        progress.finish()
+    if manifest is not None:
+        manifest.save()
+        print(manifest.summary())
+    if rejects is not None and rejects.count:
+        print('%s rows rejected, see %s' % (rejects.count, rejects.path))
+    if folders is not None and folders.collisions:
+        print('%s rows had the same folder as an earlier row' % folders.collisions)
+    if outputWriter is not None and outputWriter.skipped:
+        print('%s files were already up to date' % outputWriter.skipped)
+    if inputs is not None:
+        print(batchSummary(inputs))
+        for batchInput in inputs:
+            if batchInput.rejected:
+                print('%s rows rejected, see %s'
+                      % (batchInput.rejected, batchInput.rejects.path))
+    if stats is not None:
+        stats.addTransforms(transformRegistry.drainCounts())
+        print(stats.summary(time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+MAPPING = {
+    'metadataCreator': 'mphillips',
+    'baseDirectory': 'records',
+    'folderName': 'isbn',
+    'fields': [
+        {'type': 'basic', 'element': 'title', 'column': 'title',
+         'qualifier': 'officialtitle'},
+        {'type': 'agent', 'element': 'creator', 'column': 'author',
+         'qualifier': 'aut', 'agent_type': 'per', 'info': 'born somewhere'},
+        {'type': 'basic', 'element': 'date', 'column': 'date',
+         'qualifier': 'creation', 'required': False},
+    ],
+}
@@ -1,12 +1,27 @@
 import re
+import io
 import os
+import csv
 import json
+import pstats
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import zipfile
+import tempfile
 import unittest
+import contextlib
+from itertools import islice
+from unittest import mock
 
 from lxml import etree
 from lxml import objectify
 
-from m2m import m2m
+from pyuntl.untldoc import untlpydict2xmlstring, untlpy2dict
+
+from m2m import m2m, benchmark
 
 
 def xml_to_pretty_string(xml):
@@ -23,6 +38,119 @@ class CSVToDictTests(unittest.TestCase):
         self.assertIsInstance(csv_list, list)
         self.assertEqual(len(csv_list), 1)
 
+    def test_iter_csv_to_dict_is_lazy(self):
+        rows = m2m.iterCSVToDict('tests/data/test.csv')
+        self.assertNotIsInstance(rows, list)
+        self.assertEqual(next(rows)['isbn'], '9780547258300')
+        with self.assertRaises(StopIteration):
+            next(rows)
+
+    def test_iter_csv_to_dict_start_row(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'rows.csv')
+            with open(filename, 'w', newline='') as csv_file:
+                csv_file.write('title,isbn\nfirst,1\n\n"sec\nond",2\nthird,3\n')
+
+            rows = list(m2m.iterCSVToDict(filename, start=2))
+            self.assertEqual([row['isbn'] for row in rows], ['2', '3'])
+            self.assertEqual(rows[0]['title'], 'sec\nond')
+            self.assertEqual(list(m2m.iterCSVToDict(filename, start=4)), [])
+
+    def test_iter_csv_shard_covers_every_row_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'rows.csv')
+            with open(filename, 'w', newline='') as csv_file:
+                csv_file.write('title,isbn\nfirst,1\n\n"sec\nond",2\nthird,3\nfourth,4\n')
+
+            shards = [list(m2m.iterCSVShard(filename, shard, 3)) for shard in (1, 2, 3)]
+            self.assertEqual(m2m.countCSVRows(filename), 4)
+
+        self.assertEqual([[n for n, _ in shard] for shard in shards], [[0, 3], [1], [2]])
+        self.assertEqual(shards[1][0][1], {'title': 'sec\nond', 'isbn': '2'})
+        self.assertEqual(shards[0][1][1]['isbn'], '4')
+
+    def test_csv_index_reads_rows_directly(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'rows.csv')
+            index_path = os.path.join(tmp, 'rows.index')
+            with open(filename, 'w', newline='') as csv_file:
+                csv_file.write('title,isbn\nfirst,1\n\n"sec\nond",2\r\nthird,3\n')
+
+            index = m2m.CSVIndex(filename, index_path)
+            self.assertEqual([index.row(n) for n in range(1, 4)],
+                             list(m2m.iterCSVToDict(filename)))
+            self.assertIsNone(index.row(4))
+
+            # A saved index is read from disk instead of being rebuilt.
+            with mock.patch.object(m2m.CSVIndex, 'build') as build:
+                index = m2m.CSVIndex(filename, index_path)
+                self.assertEqual(index.row(2)['title'], 'sec\nond')
+            build.assert_not_called()
+
+            with open(filename, 'a', newline='') as csv_file:
+                csv_file.write('fourth,4\n')
+            os.utime(filename, ns=(0, 0))
+            index.refresh()
+            self.assertEqual(index.row(4)['isbn'], '4')
+            self.assertEqual(m2m.CSVIndex(filename, index_path).row(4)['isbn'], '4')
+
+    def test_crlf_line_breaks_in_cells_are_translated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'rows.csv')
+            with open(filename, 'w', newline='') as csv_file:
+                csv_file.write('title,isbn\r\n"first\r\nline",1\r\n"sec\r\nond",2\r\n')
+
+            expected = [{'title': 'first\nline', 'isbn': '1'},
+                        {'title': 'sec\nond', 'isbn': '2'}]
+            self.assertEqual(list(m2m.iterCSVToDict(filename)), expected)
+            self.assertEqual([row for _, row in m2m.iterCSVShard(filename, 1, 1)], expected)
+            self.assertEqual(m2m.countCSVRows(filename), 2)
+            index = m2m.CSVIndex(filename)
+            self.assertEqual([index.row(1), index.row(2)], expected)
+
+    def test_readers_are_picked_by_extension(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tsv = os.path.join(tmp, 'rows.tsv')
+            with open(tsv, 'w', newline='') as tsv_file:
+                tsv_file.write('title\tisbn\nfirst, one\t1\nsecond\t2\n')
+            jsonl = os.path.join(tmp, 'rows.jsonl')
+            with open(jsonl, 'w') as jsonl_file:
+                jsonl_file.write('{"title": "first, one", "isbn": 1}\n\n'
+                                 '{"title": "second", "isbn": "2", "date": null}\n')
+            database = os.path.join(tmp, 'rows.db')
+            with contextlib.closing(sqlite3.connect(database)) as connection:
+                connection.execute('CREATE TABLE books (title TEXT, isbn INTEGER)')
+                connection.executemany('INSERT INTO books VALUES (?, ?)',
+                                       [('first, one', 1), ('second', 2)])
+                connection.commit()
+
+            for filename in (tsv, jsonl, database):
+                rows = list(m2m.readRows(filename))
+                self.assertEqual([(row['title'], row['isbn']) for row in rows],
+                                 [('first, one', '1'), ('second', '2')])
+                self.assertEqual(list(m2m.readRows(filename, start=2))[0]['title'], 'second')
+            self.assertEqual(rows[1], {'title': 'second', 'isbn': '2'})
+            query = 'SELECT upper(title) AS title FROM books WHERE isbn > 1'
+            self.assertEqual(list(m2m.readRows(database, query=query)), [{'title': 'SECOND'}])
+            self.assertEqual(m2m.readerName('rows.txt'), 'csv')
+            self.assertEqual(m2m.readerName('rows.txt', 'jsonl'), 'jsonl')
+
+    def test_register_reader(self):
+        def read_pipes(filename, start=1, progress=None):
+            with open(filename) as pipe_file:
+                names = next(pipe_file).rstrip('\n').split('|')
+                for line in islice(pipe_file, start - 1, None):
+                    yield dict(zip(names, line.rstrip('\n').split('|')))
+
+        self.addCleanup(m2m.READERS.pop, 'pipes')
+        self.addCleanup(m2m.READER_EXTENSIONS.pop, '.psv')
+        m2m.registerReader('pipes', read_pipes, ['.PSV'])
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'rows.psv')
+            with open(filename, 'w') as pipe_file:
+                pipe_file.write('title|isbn\nfirst|1\n')
+            self.assertEqual(list(m2m.readRows(filename)), [{'title': 'first', 'isbn': '1'}])
+
 
 class MetadataRecordTests(unittest.TestCase):
 
@@ -82,6 +210,22 @@ class MetadataRecordTests(unittest.TestCase):
         meta_date_string = s.findall('meta[@qualifier="metadataCreationDate"]')[0].text
         self.assertTrue(date_string_regex.match(meta_date_string))
 
+    def test_record_context_fixes_creation_date(self):
+        context = m2m.RecordContext.fixed()
+        for record_class in (m2m.MetadataRecord, m2m.CompactRecord):
+            fixed_class = m2m.contextRecordClass(context, record_class)
+            with mock.patch('time.strftime') as strftime:
+                records = [fixed_class('mphillips', addDate=True) for _ in range(3)]
+            strftime.assert_not_called()
+            self.assertEqual(len({bytes(record) for record in records}), 1)
+            self.assertIn(context.creationDate.encode(), bytes(records[0]))
+            self.assertIsInstance(records[0], record_class)
+
+        record_class = m2m.contextRecordClass(m2m.RecordContext('2020-01-31, 09:30:00'))
+        s = etree.fromstring(bytes(record_class('mphillips', addDate=True)))
+        self.assertEqual(s.find('meta[@qualifier="metadataCreationDate"]').text,
+                         '2020-01-31, 09:30:00')
+
     def test_none_element_value_equals_none(self):
         # if element value is None then it should return None.
 
@@ -360,10 +504,1197 @@ class MetadataRecordTests(unittest.TestCase):
         os.rmdir(os.path.join(record.baseDirectory, record.foldername))
 
 
+class MappingPlanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.row = m2m.CSVToDict('tests/data/test.csv')[0]
+
+    def test_spec_matches_process_record(self):
+        process_record = m2m.loadMappingFunction('tests/data/test_2_untl.py')
+        plan_record = m2m.loadMappingFunction('tests/data/test_2_untl_spec.py')
+
+        expected = process_record(m2m.MetadataRecord, self.row)
+        record = plan_record(m2m.MetadataRecord, self.row)
+        self.assertEqual(bytes(record), bytes(expected))
+        self.assertEqual(record.baseDirectory, 'records')
+        self.assertEqual(record.foldername, '9780547258300')
+
+    def test_compile_validates_fields_up_front(self):
+        with self.assertRaises(m2m.MetadataConverterException) as cm:
+            m2m.MappingPlan.compile({
+                'metadataCreator': 'mphillips',
+                'fields': [{'type': 'agent', 'element': 'creator', 'column': 'author',
+                            'location': 'Denton, Texas'}],
+            })
+        self.assertEqual(str(cm.exception), 'location can only be used on publisher element')
+
+    def test_compile_rejects_unknown_field_option(self):
+        with self.assertRaises(m2m.MetadataConverterException) as cm:
+            m2m.MappingPlan.compile({
+                'metadataCreator': 'mphillips',
+                'fields': [{'type': 'basic', 'element': 'title', 'column': 'title',
+                            'qualifer': 'officialtitle'}],
+            })
+        self.assertEqual(str(cm.exception), 'Unknown option(s) for element "title": qualifer')
+
+    def test_plan_requires_value(self):
+        plan = m2m.MappingPlan.compile({
+            'metadataCreator': 'mphillips',
+            'fields': [{'type': 'basic', 'element': 'title', 'column': 'title'}],
+        })
+
+        with self.assertRaises(m2m.MetadataConverterException) as cm:
+            plan.processRecord(m2m.MetadataRecord, {'title': '  '})
+        self.assertEqual(str(cm.exception), 'Value required for element named "title"')
+
+    def test_plan_split_and_function(self):
+        plan = m2m.MappingPlan.compile({
+            'metadataCreator': 'mphillips',
+            'fields': [{'type': 'basic', 'element': 'subject', 'column': 'subjects',
+                        'split': ';', 'function': str.upper}],
+        })
+        record = plan.processRecord(m2m.MetadataRecord, {'subjects': 'cats; dogs'})
+
+        expected = m2m.MetadataRecord('mphillips')
+        expected.mapping('basic', 'subject', 'cats; dogs', split=';', function=str.upper)
+        self.assertEqual(bytes(record), bytes(expected))
+
+
+class ValidateRowsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.process_record = m2m.loadMappingFunction('tests/data/test_2_untl.py')
+
+    def test_validating_record_builds_no_tree(self):
+        record = m2m.ValidatingRecord('mphillips')
+        record.mapping('basic', 'title', 'Graceling')
+
+        self.assertIsNone(record.root_element)
+        with self.assertRaises(m2m.MetadataConverterException):
+            record.mapping('agent', 'title', 'Graceling')
+
+    def test_all_errors_are_reported(self):
+        rows = [{'title': '', 'author': 'Cashore, Kristin', 'date': '', 'isbn': '1'},
+                {'title': 'Fire', 'author': 'Cashore, Kristin', 'date': '', 'isbn': '2'},
+                {'title': 'Bitterblue', 'author': ' ', 'date': '', 'isbn': '3'}]
+
+        row_count, errors = m2m.validateRows(enumerate(rows), self.process_record)
+        self.assertEqual(row_count, 3)
+        self.assertEqual(errors, [
+            (0, 'MetadataConverterException: Value required for element named "title"'),
+            (2, 'MetadataConverterException: Value required for element named "creator"'),
+        ])
+
+
+class ColumnarPreprocessorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = m2m.MappingPlan.compile({
+            'metadataCreator': 'mphillips',
+            'fields': [
+                {'type': 'basic', 'element': 'title', 'column': 'title'},
+                {'type': 'basic', 'element': 'subject', 'column': 'subjects',
+                 'split': ';', 'required': False},
+            ],
+        })
+        self.rows = [{'title': ' Graceling\u3000', 'subjects': 'cats ;dogs; '},
+                     {'title': 'Fire', 'subjects': '  '},
+                     {'title': 'Bitterblue', 'subjects': None}]
+
+    def prepared_rows(self, rows, backend):
+        preprocessor = m2m.ColumnarPreprocessor(self.plan.fields, backend=backend, chunkSize=2)
+        return list(preprocessor.preprocessRows(enumerate(rows)))
+
+    def test_prepared_rows_match_row_by_row(self):
+        for backend in m2m.columnarBackends():
+            prepared = self.prepared_rows(self.rows, backend)
+            self.assertEqual([row for _, row in prepared], self.rows)
+            self.assertEqual(prepared[0][1].preparedValues,
+                             [['Graceling'], ['cats', 'dogs', '']])
+            self.assertEqual(prepared[1][1].preparedValues, [['Fire'], None])
+            for (_, row), original in zip(prepared, self.rows):
+                self.assertEqual(bytes(self.plan.processRecord(m2m.MetadataRecord, row)),
+                                 bytes(self.plan.processRecord(m2m.MetadataRecord, original)))
+
+    def test_errors_are_raised_for_the_same_row(self):
+        rows = self.rows + [{'title': ' ', 'subjects': 'cats'}, {'subjects': 'dogs'}]
+        for backend in m2m.columnarBackends():
+            prepared = self.prepared_rows(rows, backend)
+            self.assertIs(prepared[3][1].preparedValues[0], m2m.ROW_BY_ROW)
+            with self.assertRaises(m2m.MetadataConverterException) as cm:
+                self.plan.processRecord(m2m.MetadataRecord, prepared[3][1])
+            self.assertEqual(str(cm.exception), 'Value required for element named "title"')
+            with self.assertRaises(KeyError):
+                self.plan.processRecord(m2m.MetadataRecord, prepared[4][1])
+
+    def test_unavailable_backend(self):
+        m2m.columnarBackends()
+        with mock.patch.object(m2m, 'numpy', None):
+            self.assertNotIn('numpy', m2m.columnarBackends())
+            with self.assertRaises(m2m.MetadataConverterException):
+                m2m.ColumnarPreprocessor(self.plan.fields, backend='numpy')
+
+
+class NodeCacheTests(unittest.TestCase):
+
+    def map_publisher(self, record_class, name):
+        record = record_class('mphillips')
+        record.mapping('agent', 'publisher', name, location='Denton, Texas',
+                       info='University Press')
+        record.mapping('basic', 'rights', 'public')
+        return record
+
+    def test_cached_records_match_uncached(self):
+        record_class = m2m.cachedRecordClass(m2m.NodeCache())
+        for name in ('UNT Libraries', 'UNT Libraries', 'UNT Press'):
+            self.assertEqual(bytes(self.map_publisher(record_class, name)),
+                             bytes(self.map_publisher(m2m.MetadataRecord, name)))
+        self.assertIsNone(m2m.MetadataRecord.nodeCache)
+
+    def test_repeated_values_share_elements(self):
+        cache = m2m.NodeCache()
+        record_class = m2m.cachedRecordClass(cache)
+        first = self.map_publisher(record_class, 'UNT Libraries')
+        second = self.map_publisher(record_class, 'UNT Libraries')
+
+        self.assertIs(first.root_element.children[1], second.root_element.children[1])
+        self.assertEqual(cache.info(), {'hits': 3, 'misses': 3, 'size': 3, 'maxsize': 4096})
+
+    def test_least_recently_used_elements_are_evicted(self):
+        cache = m2m.NodeCache(maxsize=2)
+        field = m2m.FieldMapping('basic', 'subject')
+        first = cache.node(field, 'one')
+        cache.node(field, 'two')
+        cache.node(field, 'one')
+        cache.node(field, 'three')
+
+        self.assertIs(cache.node(field, 'one'), first)
+        cache.node(field, 'two')
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+
+class MemoizeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def upper(self, value):
+        self.calls.append(value)
+        return value.upper()
+
+    def test_memoized_transform_is_bounded(self):
+        upper = m2m.memoize(self.upper, maxsize=2)
+        self.assertEqual([upper(value) for value in 'aabca'], list('AABCA'))
+
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'a'])
+        self.assertEqual((upper.hits, upper.misses), (1, 4))
+        self.assertIn(upper, m2m.transformRegistry.transforms)
+
+    def test_transforms_with_the_same_name_stay_usable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_path = os.path.join(tmp, 'transforms.sqlite')
+            m2m.transformRegistry.drainCounts()
+            first = m2m.memoize(lambda value: value + '1', cachePath=cache_path)
+            second = m2m.memoize(lambda value: value + '2', cachePath=cache_path)
+            self.assertEqual((first('x'), second('x'), first('y')), ('x1', 'x2', 'y1'))
+            self.assertEqual(m2m.transformRegistry.drainCounts()['<lambda>'], (0, 3))
+            m2m.transformRegistry.close()
+
+    def test_disk_cache_is_keyed_by_function_code(self):
+        namespace = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_path = os.path.join(tmp, 'transforms.sqlite')
+            for suffix in ('A', 'B', 'B'):
+                exec('def clean(value):\n    return value + %r' % ('-' + suffix), namespace)
+                clean = m2m.memoize(namespace['clean'], cachePath=cache_path)
+                self.assertEqual(clean('x'), 'x-' + suffix)
+                clean.close()
+        self.assertEqual(clean.diskHits, 1)
+        self.assertEqual(m2m.codeFingerprint(len), '')
+
+    def test_disk_cache_persists_across_runs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_path = os.path.join(tmp, 'transforms.sqlite')
+            upper = m2m.memoize(cachePath=cache_path, name='disk_upper')(self.upper)
+            self.assertEqual(upper('a'), 'A')
+            upper.close()
+
+            upper = m2m.memoize(cachePath=cache_path, name='disk_upper')(self.upper)
+            self.assertEqual(upper('a'), 'A')
+            self.assertEqual(upper('b'), 'B')
+            upper.close()
+
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.assertEqual((upper.hits, upper.misses, upper.diskHits), (1, 1, 1))
+
+    def test_memoized_function_hook_in_mapping(self):
+        upper = m2m.memoize(self.upper)
+        records = []
+        for _ in range(3):
+            record = m2m.MetadataRecord('mphillips')
+            record.mapping('basic', 'subject', 'cats; dogs', split=';', function=upper)
+            records.append(bytes(record))
+
+        self.assertEqual(self.calls, ['cats', 'dogs'])
+        self.assertEqual(len(set(records)), 1)
+
+
+class SerializeUNTLTests(unittest.TestCase):
+
+    def build_record(self):
+        record = m2m.MetadataRecord('mphillips', addDate=True)
+        record.mapping('basic', 'date', '1982', qualifier='creation')
+        record.mapping('basic', 'title', 'Pawn of Prophecy | Queen of Sorcery', split='|',
+                       qualifier='officialtitle')
+        record.mapping('agent', 'publisher', 'UNT Libraries', location='Denton, Texas',
+                       info='Caf\u00e9 & <Press>')
+        record.mapping('agent', 'creator', 'Eddings, David', qualifier='aut', agent_type='per')
+        record.mapping('basic', 'subject', 'Fantasy')
+        return record
+
+    def test_matches_pyuntl_dict_round_trip(self):
+        record = self.build_record()
+        expected = untlpydict2xmlstring(untlpy2dict(record.root_element))
+        self.assertEqual(m2m.serializeUNTL(record.root_element), expected)
+        self.assertEqual(bytes(record), expected)
+
+    def test_elements_follow_untl_order(self):
+        s = etree.fromstring(bytes(self.build_record()))
+        self.assertEqual([child.tag for child in s],
+                         ['title', 'title', 'creator', 'publisher', 'date', 'subject',
+                          'meta', 'meta'])
+
+    def test_written_file_uses_serializer(self):
+        record = self.build_record()
+        with tempfile.TemporaryDirectory() as tmp:
+            record.writeTemplateFiles(tmp, 'folder')
+            with open(os.path.join(tmp, 'folder', 'metadata.xml'), 'rb') as xml_file:
+                self.assertEqual(xml_file.read(), m2m.serializeUNTL(record.root_element))
+
+
+class CompactRecordTests(unittest.TestCase):
+
+    def build_record(self, record_class):
+        record = record_class('mphillips')
+        record.mapping('basic', 'title', ' Pawn of Prophecy | Queen of Sorcery', split='|',
+                       qualifier='officialtitle')
+        record.mapping('agent', 'publisher', 'UNT Libraries', location='Denton, Texas',
+                       info='Caf\u00e9 & <Press>')
+        record.mapping('agent', 'creator', 'Eddings, David', qualifier='aut', agent_type='per')
+        record.mapping('basic', 'subject', 'Fantasy;', split=';', required=False)
+        return record
+
+    def test_matches_tree_record(self):
+        expected = bytes(self.build_record(m2m.MetadataRecord))
+        record = self.build_record(m2m.CompactRecord)
+
+        self.assertEqual(bytes(record), expected)
+        self.assertIsNone(record._root)
+        self.assertEqual(record.elements[1], ('title', 'officialtitle', 'Pawn of Prophecy', ()))
+
+    def test_tree_is_built_when_used(self):
+        expected = self.build_record(m2m.MetadataRecord)
+        expected.mapping('basic', 'note', 'Added later')
+        record = self.build_record(m2m.CompactRecord)
+
+        self.assertEqual(m2m.serializeUNTL(record.root_element), bytes(self.build_record(
+            m2m.MetadataRecord)))
+        record.mapping('basic', 'note', 'Added later')
+        self.assertEqual(bytes(record), bytes(expected))
+        self.assertEqual(len(record.root_element.children), len(expected.root_element.children))
+
+    def test_field_configurations_are_checked_once(self):
+        m2m._acceptedFields.clear()
+        with mock.patch.object(m2m, 'buildFieldElement',
+                               side_effect=m2m.buildFieldElement) as build_field:
+            for name in ('Eddings, David', 'Eddings, Leigh'):
+                record = m2m.CompactRecord('mphillips')
+                record.mapping('agent', 'creator', name, qualifier='aut', agent_type='per')
+            field = m2m.FieldMapping('agent', 'creator', qualifier='aut', agent_type='per')
+            m2m.CompactRecord('mphillips').applyField(field, 'Eddings, David')
+            record.mapping('agent', 'creator', 'Eddings, David', qualifier='aut')
+        creators = [call for call in build_field.call_args_list
+                    if call[0][0].elementName == 'creator']
+        self.assertEqual([call[0][0].agent_type for call in creators], ['per', ''])
+
+    def test_field_check_cache_is_bounded(self):
+        m2m._acceptedFields.clear()
+        with mock.patch.object(m2m, 'ACCEPTED_FIELDS_SIZE', 2):
+            for qualifier in ('aut', 'edt', 'ill'):
+                m2m.CompactRecord('mphillips').mapping('agent', 'creator', 'Eddings, David',
+                                                       qualifier=qualifier)
+        self.assertEqual(len(m2m._acceptedFields), 2)
+
+    def test_pyuntl_errors_are_kept(self):
+        for record_class in (m2m.MetadataRecord, m2m.CompactRecord):
+            record = record_class('mphillips')
+            with self.assertRaises(Exception) as cm:
+                record.mapping('agent', 'publisher', 'UNT Libraries', agent_type='org')
+            self.assertEqual(str(cm.exception), 'Invalid child "type" for parent "publisher"')
+
+
+class OutputWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def read(self, *path):
+        with open(os.path.join(self.tmp.name, *path), 'rb') as f:
+            return f.read()
+
+    def test_creates_each_directory_once(self):
+        writer = m2m.OutputWriter()
+        with mock.patch('os.makedirs', side_effect=os.makedirs) as makedirs:
+            writer.writeFile(self.tmp.name, 'folder', 'metadata.xml', b'<metadata/>')
+            writer.writeFile(self.tmp.name, 'folder', 'metadata.json', b'{}')
+        writer.close()
+
+        self.assertEqual(makedirs.call_count, 1)
+        self.assertEqual(self.read('folder', 'metadata.xml'), b'<metadata/>')
+        self.assertEqual(self.read('folder', 'metadata.json'), b'{}')
+
+    def test_recreates_removed_directory(self):
+        writer = m2m.OutputWriter()
+        folder = os.path.join(self.tmp.name, 'folder')
+        writer.writeFile(self.tmp.name, 'folder', 'metadata.xml', b'one')
+        os.remove(os.path.join(folder, 'metadata.xml'))
+        os.rmdir(folder)
+        writer.writeFile(self.tmp.name, 'folder', 'metadata.xml', b'two')
+
+        self.assertEqual(self.read('folder', 'metadata.xml'), b'two')
+
+    def test_skip_unchanged_files(self):
+        for options in ({}, {'atomic': True}):
+            writer = m2m.OutputWriter(skipUnchanged=True, **options)
+            writer.writeFile(self.tmp.name, 'folder', 'metadata.xml', b'one')
+            with mock.patch.object(writer, '_writeBytes') as write_bytes:
+                writer.writeFile(self.tmp.name, 'folder', 'metadata.xml', b'one')
+            write_bytes.assert_not_called()
+            writer.writeFile(self.tmp.name, 'folder', 'metadata.xml', b'two')
+            writer.writeFile(self.tmp.name, 'folder', 'metadata.xml', b'three')
+            writer.close()
+
+            self.assertEqual(writer.skipped, 1)
+            self.assertEqual(self.read('folder', 'metadata.xml'), b'three')
+            shutil.rmtree(os.path.join(self.tmp.name, 'folder'))
+
+    def test_threaded_atomic_batched_writes(self):
+        writer = m2m.OutputWriter(threads=3, maxPending=2, atomic=True, fsyncBatch=4)
+        for n in range(10):
+            writer.writeFile(self.tmp.name, str(n), 'metadata.xml', b'%d' % n)
+        writer.close()
+
+        for n in range(10):
+            self.assertEqual(self.read(str(n), 'metadata.xml'), b'%d' % n)
+        leftovers = [name for _, _, names in os.walk(self.tmp.name)
+                     for name in names if name.endswith('.tmp')]
+        self.assertEqual(leftovers, [])
+
+    def test_threaded_write_failure_is_raised_once(self):
+        writer = m2m.OutputWriter(threads=2)
+        with mock.patch.object(writer, '_writeBytes',
+                               side_effect=[OSError('disk full'), None]) as write_bytes:
+            writer.writeFile(self.tmp.name, 'one', 'metadata.xml', b'one')
+            with self.assertRaises(OSError):
+                writer.flush()
+            writer.writeFile(self.tmp.name, 'two', 'metadata.xml', b'two')
+            writer.close()
+        self.assertEqual(write_bytes.call_count, 2)
+
+    def test_record_writes_through_writer(self):
+        record = m2m.MetadataRecord('mphillips')
+        writer = mock.Mock()
+        record.writeTemplateFiles('out', 'folder', writer=writer)
+        record.writeJSONFile('out', 'folder', {'test': 'data'}, writer=writer)
+
+        writer.writeFile.assert_has_calls([
+            mock.call('out', 'folder', 'metadata.xml', bytes(record)),
+            mock.call('out', 'folder', 'metadata.json',
+                      b'{\n    "test": "data"\n}'),
+        ])
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_read_ahead_keeps_order_and_errors(self):
+        def rows():
+            yield from range(100)
+            raise ValueError('bad row')
+
+        items = m2m.readAhead(rows(), maxPending=4)
+        self.assertEqual([next(items) for _ in range(100)], list(range(100)))
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_writer_thread_completes_rows_in_order(self):
+        collected = m2m.CollectingWriter()
+        writer = m2m.WriterThread(collected, maxPending=2)
+        completed = []
+        for n in range(10):
+            writer.writeFile('records', 'id%s' % n, 'metadata.xml', b'<metadata/>')
+            writer.rowDone(n, 'id%s' % n)
+            completed.extend(writer.completed())
+        writer.flush()
+        completed.extend(writer.completed())
+        writer.close()
+
+        self.assertEqual(completed, [(n, 'id%s' % n, None) for n in range(10)])
+        self.assertEqual([f[1] for f in collected.files], ['id%s' % n for n in range(10)])
+
+    def test_writer_thread_raises_failed_write(self):
+        collected = m2m.CollectingWriter()
+        writer = m2m.WriterThread(collected)
+        with mock.patch.object(collected, 'writeFile', side_effect=OSError('disk full')):
+            writer.writeFile('records', 'id1', 'metadata.xml', b'<metadata/>')
+            with self.assertRaises(OSError):
+                writer.flush()
+        writer.close()
+
+    def test_writer_thread_reports_failed_write_with_its_row(self):
+        collected = m2m.CollectingWriter()
+        writer = m2m.WriterThread(collected)
+        error = OSError('disk full')
+        with mock.patch.object(collected, 'writeFile',
+                               side_effect=[error, None, None, None, None]) as write_file:
+            for n in range(3):
+                writer.writeFile('records', 'id%s' % n, 'metadata.xml', b'<metadata/>')
+                writer.writeFile('records', 'id%s' % n, 'metadata.json', b'{}')
+                writer.rowDone(n, 'id%s' % n)
+            writer.flush()
+        writer.close()
+
+        self.assertEqual(list(writer.completed()),
+                         [(0, 'id0', error), (1, 'id1', None), (2, 'id2', None)])
+        # The rest of the failed row's files are skipped.
+        self.assertEqual(write_file.call_count, 5)
+
+
+class ArchiveWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write_archive(self, filename):
+        path = os.path.join(self.tmp.name, filename)
+        writer = m2m.ArchiveWriter(path)
+        writer.writeFile('records', 'one', 'metadata.xml', b'<metadata/>')
+        writer.writeFile('records', 'two', 'metadata.json', b'{}')
+        writer.close()
+        return path
+
+    def test_tar_archive(self):
+        with tarfile.open(self.write_archive('records.tar.gz')) as archive:
+            self.assertEqual(archive.getnames(), ['one/metadata.xml', 'two/metadata.json'])
+            self.assertEqual(archive.extractfile('one/metadata.xml').read(), b'<metadata/>')
+
+    def test_zip_archive(self):
+        with zipfile.ZipFile(self.write_archive('records.zip')) as archive:
+            self.assertEqual(archive.namelist(), ['one/metadata.xml', 'two/metadata.json'])
+            self.assertEqual(archive.read('two/metadata.json'), b'{}')
+
+
+class ProgressReporterTests(unittest.TestCase):
+
+    def test_report_includes_rate_and_eta(self):
+        stream = io.StringIO()
+        progress = m2m.ProgressReporter(totalSize=100, interval=0, stream=stream)
+        list(progress.countLines(['a' * 25 + '\n']))
+        progress.update(10)
+        progress.report()
+
+        self.assertRegex(stream.getvalue(),
+                         r'^Processed 10 rows \([\d.]+ rows/sec\), about 26% done, ETA ')
+
+    def test_instrumented_record_matches_plain_record(self):
+        stats = m2m.RunStats()
+        record_class = m2m.instrumentedRecordClass(stats)
+        record = record_class('mphillips')
+        record.mapping('basic', 'title', 'Title', qualifier='officialtitle')
+        expected = m2m.MetadataRecord('mphillips')
+        expected.mapping('basic', 'title', 'Title', qualifier='officialtitle')
+
+        self.assertEqual(bytes(record), bytes(expected))
+        self.assertEqual(stats.fieldCalls, {'meta/metadataCreator': 1,
+                                            'title/officialtitle': 1})
+        self.assertGreater(stats.seconds['serialize'], 0)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_benchmark_reports_stages(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'bench.json')
+            with contextlib.redirect_stdout(io.StringIO()):
+                benchmark.main(['--rows', '20', '--fields', '2', '--workdir', tmp,
+                                '--output', output])
+            with open(output) as results_file:
+                results = json.load(results_file)
+
+        self.assertEqual(results['rows'], 20)
+        self.assertEqual(sorted(results['stageSeconds']),
+                         ['map', 'parse', 'serialize', 'write'])
+        self.assertGreater(results['rowsPerSecond'], 0)
+
+    def test_synthetic_mapping_converts_synthetic_csv(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, 'bench.csv')
+            mapping_path = os.path.join(tmp, 'bench_untl.py')
+            benchmark.writeSyntheticCSV(csv_path, 3, 2)
+            benchmark.writeSyntheticMapping(mapping_path, 2, 'records')
+
+            process_record = m2m.loadMappingFunction(mapping_path)
+            row = m2m.CSVToDict(csv_path)[1]
+            record = process_record(m2m.MetadataRecord, row)
+
+        s = etree.fromstring(bytes(record))
+        self.assertEqual(len(s.findall('subject')), 4)
+        self.assertEqual(record.foldername, row['isbn'])
+
+
+MAPPING_TEMPLATE = """
+def processRecord(RecordClass, row):
+    record = RecordClass('mphillips')
+    record.mapping('basic', 'title', row['title'], qualifier='officialtitle')
+    record.mapping('agent', 'creator', row['author'],
+                   qualifier='aut', agent_type='per', info='born somewhere')
+    record.mapping('basic', 'date', row['date'],
+                   qualifier='creation', required=False)
+    record.setBaseDirectory(%r)
+    record.setFolderName(row['isbn'])
+    return record
+"""
+
+
+MEMOIZED_MAPPING = """
+@memoize(maxsize=100)
+def shout(value):
+    return value.upper()
+
+
+def processRecord(RecordClass, row):
+    record = RecordClass('mphillips')
+    record.mapping('basic', 'title', row['title'], qualifier='officialtitle',
+                   function=shout)
+    record.setBaseDirectory(%r)
+    record.setFolderName(row['isbn'])
+    return record
+"""
+
+
+class CommandLineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.output = os.path.join(self.tmp.name, 'records')
+        self.mapping = os.path.join(self.tmp.name, 'mapping.py')
+        with open(self.mapping, 'w') as mapping_file:
+            mapping_file.write(MAPPING_TEMPLATE % self.output)
+
+    def run_main(self, *args, csv_file='tests/data/test.csv'):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            m2m.main(['-m', self.mapping, csv_file] + list(args))
+        return stdout.getvalue()
+
+    def write_csv(self, rows, name='input.csv'):
+        filename = os.path.join(self.tmp.name, name)
+        with open(filename, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['title', 'author', 'date', 'isbn'])
+            writer.writerows(rows)
+        return filename
+
+    def test_write_and_json_build_record_once(self):
+        with mock.patch.object(m2m, 'MetadataRecord',
+                               side_effect=m2m.MetadataRecord) as record_class:
+            output = self.run_main('-w', '-j')
+
+        self.assertNotIn('<metadata>', output)
+
+        self.assertEqual(record_class.call_count, 1)
+        folder = os.path.join(self.output, '9780547258300')
+        self.assertTrue(os.path.exists(os.path.join(folder, 'metadata.xml')))
+        self.assertTrue(os.path.exists(os.path.join(folder, 'metadata.json')))
+
+    def test_invalid_row_number(self):
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('-n', '5')
+        self.assertEqual(str(cm.exception), 'Sorry, 5 is not a valid row number.')
+
+    def test_parallel_jobs_write_records_in_order(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '2020', 'id%02d' % n] for n in range(10)]
+        csv_file = self.write_csv(rows)
+
+        output = self.run_main('-w', '-v', '--jobs', '3', csv_file=csv_file)
+
+        progress = [line for line in output.splitlines() if line.startswith('Writing')]
+        self.assertEqual(progress, ['Writing record for row %s' % n for n in range(10)])
+        for n in range(10):
+            filename = os.path.join(self.output, 'id%02d' % n, 'metadata.xml')
+            self.assertIn(b'Title %d</title>' % n, open(filename, 'rb').read())
+
+    def test_incremental_skips_unchanged_rows(self):
+        manifest = os.path.join(self.tmp.name, 'manifest.json')
+        rows = [['Title %s' % n, 'Author', '', 'id%s' % n] for n in range(3)]
+        output = self.run_main('-w', '--incremental', manifest, csv_file=self.write_csv(rows))
+        self.assertIn('3 added, 0 changed, 0 removed, 0 unchanged', output)
+
+        rows[1][0] = 'New Title'
+        rows[2][3] = 'id9'
+        csv_file = self.write_csv(rows)
+        with mock.patch.object(m2m, 'MetadataRecord',
+                               side_effect=m2m.MetadataRecord) as record_class:
+            output = self.run_main('-w', '--incremental', manifest, csv_file=csv_file)
+
+        self.assertEqual(record_class.call_count, 2)
+        self.assertIn('1 added, 1 changed, 1 removed, 1 unchanged', output)
+        self.assertIn('removed %s' % os.path.join(self.output, 'id2'), output)
+        with open(os.path.join(self.output, 'id1', 'metadata.xml'), 'rb') as xml_file:
+            self.assertIn(b'New Title', xml_file.read())
+
+    def test_incremental_rebuilds_deleted_outputs(self):
+        manifest = os.path.join(self.tmp.name, 'manifest.json')
+        rows = [['Title %s' % n, 'Author', '', 'id%s' % n] for n in range(3)]
+        csv_file = self.write_csv(rows)
+        self.run_main('-w', '-j', '--incremental', manifest, csv_file=csv_file)
+        os.remove(os.path.join(self.output, 'id0', 'metadata.json'))
+        shutil.rmtree(os.path.join(self.output, 'id2'))
+
+        output = self.run_main('-w', '-j', '--incremental', manifest, csv_file=csv_file)
+        self.assertIn('0 added, 2 changed, 0 removed, 1 unchanged', output)
+        for n in range(3):
+            for filename in ('metadata.xml', 'metadata.json'):
+                self.assertTrue(os.path.exists(os.path.join(self.output, 'id%s' % n, filename)))
+
+    def test_incremental_rebuilds_when_mapping_changes(self):
+        manifest = os.path.join(self.tmp.name, 'manifest.json')
+        self.run_main('-w', '--incremental', manifest)
+        with open(self.mapping, 'a') as mapping_file:
+            mapping_file.write('\n# changed\n')
+
+        output = self.run_main('-w', '--incremental', manifest)
+        self.assertIn('0 added, 1 changed, 0 removed, 0 unchanged', output)
+
+    def test_archive_output(self):
+        rows = [['Title %s' % n, 'Author', '', 'id%s' % n] for n in range(4)]
+        csv_file = self.write_csv(rows)
+        for jobs in ('1', '2'):
+            archive_path = os.path.join(self.tmp.name, 'records-%s.tar' % jobs)
+            self.run_main('-w', '-j', '--archive', archive_path, '--jobs', jobs,
+                          csv_file=csv_file)
+
+            with tarfile.open(archive_path) as archive:
+                names = archive.getnames()
+            self.assertEqual(names, ['id%s/metadata.%s' % (n, ext)
+                                     for n in range(4) for ext in ('xml', 'json')])
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_jsonl_output(self):
+        rows = [['Title %s' % n, 'Author', '', 'id%s' % n] for n in range(3)]
+        csv_file = self.write_csv(rows)
+        jsonl = os.path.join(self.tmp.name, 'records.jsonl')
+
+        for jobs in ('1', '2'):
+            self.run_main('--jsonl', jsonl, '--jsonl-untl', '--jobs', jobs, csv_file=csv_file)
+            with open(jsonl) as jsonl_file:
+                lines = [json.loads(line) for line in jsonl_file]
+
+            self.assertEqual([line['foldername'] for line in lines], ['id0', 'id1', 'id2'])
+            self.assertEqual(lines[1]['data']['title'], 'Title 1')
+            self.assertIn('<title qualifier="officialtitle">Title 1</title>', lines[1]['untl'])
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_jsonl_to_stdout(self):
+        with mock.patch('sys.stderr'):
+            output = self.run_main('--jsonl', '-')
+
+        self.assertEqual(json.loads(output), {
+            'foldername': '9780547258300',
+            'data': {'title': 'Graceling', 'author': 'Kristin Cashore',
+                     'date': '2008', 'isbn': '9780547258300'},
+        })
+
+    def test_write_progress_is_periodic(self):
+        rows = [['Title %s' % n, 'Author', '', 'id%s' % n] for n in range(3)]
+        csv_file = self.write_csv(rows)
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            output = self.run_main('-w', csv_file=csv_file)
+
+        self.assertNotIn('Writing record for row', output)
+        self.assertRegex(stderr.getvalue(), r'Processed 3 rows in [\d.]+s')
+
+    def test_columnar_output_matches(self):
+        self.mapping = 'tests/data/test_2_untl_spec.py'
+        expected = self.run_main()
+
+        self.assertEqual(self.run_main('--columnar', '--columnar-backend', 'python'), expected)
+
+    def test_columnar_requires_mapping_spec(self):
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--columnar')
+        self.assertEqual(str(cm.exception),
+                         '--columnar requires a mapping file with a MAPPING spec.')
+
+    def test_stats_summary(self):
+        for jobs in ('1', '2'):
+            with mock.patch('sys.stderr'):
+                output = self.run_main('-w', '--stats', '--jobs', jobs)
+
+            for stage in ('parse', 'map', 'serialize', 'write'):
+                self.assertRegex(output, r'\n  %s +[\d.]+s' % stage)
+            self.assertRegex(output, r'\n  rows +1\n')
+            self.assertRegex(output, r'\n  files +1\n')
+            self.assertRegex(output, r'\n  title/officialtitle +[\d.]+s +1 calls')
+
+    def test_node_cache_counters(self):
+        with mock.patch('sys.stderr'):
+            output = self.run_main('--stats', '--node-cache', '100')
+
+        self.assertRegex(output, r'\n  nodeCacheMisses +4\n')
+
+    def test_memoized_transform_in_mapping_file(self):
+        with open(self.mapping, 'w') as mapping_file:
+            mapping_file.write(MEMOIZED_MAPPING % self.output)
+        with mock.patch('sys.stderr'):
+            output = self.run_main('--stats')
+
+        self.assertIn('<title qualifier="officialtitle">GRACELING</title>', output)
+        self.assertRegex(output, r'\n  shout +0 hits +1 misses +0.0% hit rate')
+
+    def test_disk_cache_with_parallel_jobs(self):
+        cache_path = os.path.join(self.tmp.name, 'shout.sqlite')
+        with open(self.mapping, 'w') as mapping_file:
+            mapping_file.write(MEMOIZED_MAPPING.replace(
+                '@memoize(maxsize=100)', '@memoize(maxsize=2, cachePath=%r)' % cache_path)
+                % self.output)
+        rows = [['Title %s' % (n % 50), 'Author', '', 'id%s' % n] for n in range(400)]
+        csv_file = self.write_csv(rows)
+
+        self.run_main('-w', '--jobs', '4', csv_file=csv_file)
+        self.assertEqual(len(os.listdir(self.output)), 400)
+        with contextlib.closing(sqlite3.connect(cache_path)) as connection:
+            self.assertEqual(connection.execute('SELECT count(*) FROM transforms').fetchone(),
+                             (50,))
+
+    def test_profile_output(self):
+        profile = os.path.join(self.tmp.name, 'm2m.prof')
+        with mock.patch('sys.stderr'):
+            self.run_main('--profile', profile)
+
+        self.assertGreater(pstats.Stats(profile).total_calls, 0)
+
+    def test_parallel_jobs_with_write_behind(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '', 'id%s' % n] for n in range(6)]
+        csv_file = self.write_csv(rows)
+
+        self.run_main('-w', '-j', '--jobs', '2', '--write-threads', '2', '--atomic',
+                      '--fsync-batch', '4', csv_file=csv_file)
+
+        for n in range(6):
+            folder = os.path.join(self.output, 'id%s' % n)
+            self.assertEqual(sorted(os.listdir(folder)), ['metadata.json', 'metadata.xml'])
+
+    def test_compact_records_match_output(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '', 'id%s' % n] for n in range(3)]
+        csv_file = self.write_csv(rows)
+
+        expected = self.run_main(csv_file=csv_file)
+        self.assertEqual(self.run_main('--compact', csv_file=csv_file), expected)
+        self.assertEqual(self.run_main('--compact', '--jobs', '2', csv_file=csv_file), expected)
+
+    def test_shards_and_merge_check(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '', 'id%s' % n] for n in range(5)]
+        csv_file = self.write_csv(rows)
+        manifests = [os.path.join(self.tmp.name, 'shard%s.json' % n) for n in (1, 2)]
+
+        output = self.run_main('-w', '-v', '--shard', '1/2', '--shard-manifest', manifests[0],
+                               csv_file=csv_file)
+        self.assertEqual(re.findall(r'Writing record for row (\d)', output), ['0', '2', '4'])
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--merge-shards', manifests[0], csv_file=csv_file)
+        self.assertEqual(str(cm.exception), 'Shard 2/2 is missing\n'
+                                            '2 rows were not converted: 1, 3')
+
+        self.run_main('-w', '--shard', '2/2', '--shard-manifest', manifests[1],
+                      csv_file=csv_file)
+        output = self.run_main('--merge-shards', manifests[0], '--merge-shards', manifests[1],
+                               csv_file=csv_file)
+        self.assertIn('Every row of %s was converted exactly once by 2 shards.' % csv_file,
+                      output)
+
+        # The order the README documents, with the CSV after a pattern.
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            m2m.main(['-m', self.mapping, '--merge-shards',
+                      os.path.join(self.tmp.name, 'shard*.json'), csv_file])
+        self.assertIn('exactly once by 2 shards.', stdout.getvalue())
+        # An unquoted pattern leaves the manifests after the first as CSV files.
+        with self.assertRaises(SystemExit) as cm:
+            m2m.main(['-m', self.mapping, '--merge-shards'] + manifests + [csv_file])
+        self.assertIn('--merge-shards takes one manifest', str(cm.exception))
+        self.assertEqual(sorted(os.listdir(self.output)), ['id%s' % n for n in range(5)])
+
+    def test_merge_check_finds_folder_collisions(self):
+        csv_file = self.write_csv([['Title', 'Author', '', 'id1'], ['Other', 'Author', '', 'id1']])
+        manifests = [os.path.join(self.tmp.name, 'shard%s.json' % n) for n in (1, 2)]
+        for n, manifest in enumerate(manifests, 1):
+            self.run_main('--shard', '%s/2' % n, '--shard-manifest', manifest,
+                          csv_file=csv_file)
+
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--merge-shards', manifests[0], '--merge-shards', manifests[1],
+                          csv_file=csv_file)
+        self.assertEqual(str(cm.exception), 'Folder %s was written by rows 0, 1'
+                                            % os.path.join(self.output, 'id1'))
+
+    def test_row_lookup_with_index(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '', 'id%s' % n] for n in range(5)]
+        csv_file = self.write_csv(rows)
+        index = os.path.join(self.tmp.name, 'input.index')
+
+        for row in ('1', '4'):
+            expected = self.run_main('--row', row, csv_file=csv_file)
+            self.assertEqual(self.run_main('--row', row, '--index', index, csv_file=csv_file),
+                             expected)
+        self.assertTrue(os.path.exists(index))
+        with self.assertRaises(SystemExit):
+            self.run_main('--row', '6', '--index', index, csv_file=csv_file)
+
+    def test_serve_answers_each_request(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '', 'id%s' % n] for n in range(3)]
+        rows[1][0] = ''
+        csv_file = self.write_csv(rows)
+
+        with mock.patch('sys.stdin', io.StringIO('3\n\n2\n9\n')):
+            output = self.run_main('--serve', '-w', csv_file=csv_file)
+
+        responses = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(responses[0]['foldername'], 'id2')
+        self.assertIn('<title qualifier="officialtitle">Title 2</title>', responses[0]['untl'])
+        self.assertEqual(responses[1], {'error': 'MetadataConverterException: Value required '
+                                                 'for element named "title"'})
+        self.assertEqual(responses[2], {'error': 'MetadataConverterException: '
+                                                 '9 is not a valid row number'})
+        self.assertEqual(os.listdir(self.output), ['id2'])
+
+    def test_import_is_lazy(self):
+        code = 'import sys; from m2m import m2m; print(sorted(set(sys.modules) & %r))' % {
+            'lxml', 'pyuntl', 'sqlite3', 'multiprocessing', 'numpy', 'pyarrow'}
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_pipeline_matches_serial_output(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '', 'id%s' % n] for n in range(5)]
+        rows[2][1] = ''
+        csv_file = self.write_csv(rows)
+        rejects = os.path.join(self.tmp.name, 'rejects.csv')
+
+        expected = self.run_main('-w', '-j', '-v', '--continue-on-error', '--rejects', rejects,
+                                 csv_file=csv_file)
+        written = {}
+        for folder in os.listdir(self.output):
+            with open(os.path.join(self.output, folder, 'metadata.xml'), 'rb') as f:
+                written[folder] = f.read()
+        shutil.rmtree(self.output)
+
+        output = self.run_main('-w', '-j', '-v', '--continue-on-error', '--rejects', rejects,
+                               '--pipeline', csv_file=csv_file)
+        self.assertEqual(output, expected)
+        for folder, data in written.items():
+            with open(os.path.join(self.output, folder, 'metadata.xml'), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(sorted(os.listdir(self.output)), ['id0', 'id1', 'id3', 'id4'])
+
+    def test_pipeline_rejects_the_row_whose_write_failed(self):
+        rows = [['Title %s' % n, 'Author', '', 'id%s' % n] for n in range(10)]
+        csv_file = self.write_csv(rows)
+        rejects = os.path.join(self.tmp.name, 'rejects.csv')
+        checkpoint = os.path.join(self.tmp.name, 'checkpoint.json')
+        os.makedirs(self.output)
+        with open(os.path.join(self.output, 'id3'), 'w'):
+            pass
+
+        output = self.run_main('-w', '--pipeline', '--continue-on-error', '--rejects', rejects,
+                               '--resume', checkpoint, csv_file=csv_file)
+
+        self.assertIn('1 rows rejected', output)
+        with open(rejects, newline='') as rejects_file:
+            self.assertEqual([row['m2m_row'] for row in csv.DictReader(rejects_file)], ['3'])
+        self.assertEqual(sorted(os.listdir(self.output)), ['id%s' % n for n in range(10)])
+        for n in (2, 4, 5, 9):
+            self.assertTrue(os.path.exists(os.path.join(self.output, 'id%s' % n,
+                                                        'metadata.xml')))
+        with open(checkpoint) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)['lastRow'], 9)
+
+    def test_parallel_jobs_match_serial_output(self):
+        rows = [['Title %s' % n, 'Author %s' % n, '', 'id%s' % n] for n in range(5)]
+        csv_file = self.write_csv(rows)
+
+        self.assertEqual(self.run_main('--jobs', '2', csv_file=csv_file),
+                         self.run_main(csv_file=csv_file))
+
+    def test_validate_only_reports_every_error(self):
+        csv_file = self.write_csv([['', 'Author', '', 'id1'], ['Title', 'Author', '', 'id2'],
+                                   ['', 'Author', '', 'id3']])
+
+        stdout = io.StringIO()
+        with self.assertRaises(SystemExit) as cm, contextlib.redirect_stdout(stdout):
+            m2m.main(['-m', self.mapping, csv_file, '-w', '--validate-only'])
+        self.assertEqual(str(cm.exception), '2 of 3 rows failed validation.')
+        self.assertIn('Row 0: MetadataConverterException: Value required for element named'
+                      ' "title"\nRow 2: ', stdout.getvalue())
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_validate_before_converting(self):
+        output = self.run_main('-w', '--validate')
+
+        self.assertIn('1 rows passed validation.', output)
+        self.assertTrue(os.path.exists(os.path.join(self.output, '9780547258300',
+                                                    'metadata.xml')))
+
+    def test_continue_on_error_writes_rejects(self):
+        csv_file = self.write_csv([['', 'Author', '', 'id1'], ['Title', 'Author', '', 'id2'],
+                                   ['Title', '', '', 'id3']])
+        rejects = os.path.join(self.tmp.name, 'rejects.csv')
+
+        for jobs in ('1', '2'):
+            output = self.run_main('-w', '--continue-on-error', '--rejects', rejects,
+                                   '--jobs', jobs, csv_file=csv_file)
+
+            self.assertIn('2 rows rejected, see %s' % rejects, output)
+            self.assertEqual(os.listdir(self.output), ['id2'])
+            with open(rejects, newline='') as rejects_file:
+                rows = list(csv.DictReader(rejects_file))
+            self.assertEqual([(row['isbn'], row['m2m_row']) for row in rows],
+                             [('id1', '0'), ('id3', '2')])
+            self.assertEqual(rows[1]['m2m_error'], 'MetadataConverterException: '
+                                                   'Value required for element named "creator"')
+
+    def test_resume_after_failed_run(self):
+        csv_file = self.write_csv([['Title', 'Author', '', 'id1'], ['', 'Author', '', 'id2']])
+        checkpoint = os.path.join(self.tmp.name, 'checkpoint.json')
+
+        with self.assertRaises(m2m.MetadataConverterException):
+            self.run_main('-w', '--resume', checkpoint, csv_file=csv_file)
+        with open(checkpoint) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)['lastRow'], 0)
+
+        # Fix the bad row, and only it is converted on the next run.
+        self.write_csv([['Title', 'Author', '', 'id1'], ['Title', 'Author', '', 'id2']])
+        output = self.run_main('-w', '-v', '--resume', checkpoint, csv_file=csv_file)
+        self.assertIn('Resuming after row 0\n', output)
+        self.assertNotIn('Writing record for row 0', output)
+        self.assertIn('Writing record for row 1', output)
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'id2', 'metadata.xml')))
+        with open(checkpoint) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)['lastRow'], 1)
+
+    def test_resume_rejects_changed_rows(self):
+        csv_file = self.write_csv([['Title', 'Author', '', 'id1'], ['', 'Author', '', 'id2']])
+        checkpoint = os.path.join(self.tmp.name, 'checkpoint.json')
+        with self.assertRaises(m2m.MetadataConverterException):
+            self.run_main('-w', '--resume', checkpoint, csv_file=csv_file)
+
+        # A new export at the same path doesn't match the rows already done.
+        self.write_csv([['Changed', 'Author', '', 'id1'], ['Title', 'Author', '', 'id2']])
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('-w', '--resume', checkpoint, csv_file=csv_file)
+        self.assertIn('Rows 0 to 0 of %s have changed since checkpoint' % csv_file,
+                      str(cm.exception))
+        self.assertFalse(os.path.exists(os.path.join(self.output, 'id2')))
+
+    def test_continue_on_error_rejects_write_threads(self):
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('-w', '--continue-on-error', '--write-threads', '2')
+        self.assertEqual(str(cm.exception),
+                         '--continue-on-error cannot be combined with --write-threads.')
+
+    def test_resume_rejects_other_mapping(self):
+        checkpoint = os.path.join(self.tmp.name, 'checkpoint.json')
+        self.run_main('--resume', checkpoint)
+
+        with open(self.mapping, 'a') as mapping_file:
+            mapping_file.write('\n# changed\n')
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--resume', checkpoint)
+        self.assertIn('was written for a different CSV or mapping file', str(cm.exception))
+
+    def test_parallel_jobs_stop_on_error(self):
+        csv_file = self.write_csv([['Title', 'Author', '', 'id1'], ['', 'Author', '', 'id2']])
+
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--jobs', '2', csv_file=csv_file)
+        self.assertEqual(str(cm.exception), 'Error processing row 1: MetadataConverterException:'
+                                            ' Value required for element named "title"')
+
+    def test_parallel_jobs_stop_on_early_error_in_large_csv(self):
+        # Many more rows than convertRowsInParallel keeps in flight.
+        rows = [['Title', 'Author', '', 'id%s' % n] for n in range(1000)]
+        rows[10][0] = ''
+        csv_file = self.write_csv(rows)
+
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('-w', '--jobs', '2', csv_file=csv_file)
+        self.assertEqual(str(cm.exception), 'Error processing row 10: MetadataConverterException:'
+                                            ' Value required for element named "title"')
+
+    def test_batch_converts_every_csv_with_mapping_compiled_once(self):
+        self.write_csv([['Title 1', 'Author', '', 'id1'], ['Title 2', 'Author', '', 'id2']],
+                       name='a.csv')
+        self.write_csv([['Title 3', 'Author', '', 'id3']], name='b.csv')
+        pattern = os.path.join(self.tmp.name, '*.csv')
+
+        with mock.patch.object(m2m, 'loadMappingFunction',
+                               side_effect=m2m.loadMappingFunction) as load:
+            for jobs in ('1', '2'):
+                m2m._mappingCache.clear()
+                output = self.run_main('-w', '--jobs', jobs, csv_file=pattern)
+                self.assertEqual(sorted(os.listdir(self.output)), ['id1', 'id2', 'id3'])
+                shutil.rmtree(self.output)
+        self.assertEqual(load.call_count, 1)
+        self.assertIn('Processing 2 CSV files\n', output)
+        self.assertIn('2 CSV files: 3 rows, 0 rejected\n', output)
+        self.assertIn('b.csv: 1 rows, 0 rejected', output)
+
+    def test_batch_manifest_pairs_csvs_with_mappings(self):
+        self.write_csv([['Title 1', 'Author', '', 'id1']], name='a.csv')
+        self.write_csv([['', 'Author', '', 'id2'], ['Title 3', 'Author', '', 'id3']],
+                       name='b.csv')
+        other_output = os.path.join(self.tmp.name, 'other')
+        with open(os.path.join(self.tmp.name, 'other.py'), 'w') as mapping_file:
+            mapping_file.write(MAPPING_TEMPLATE % other_output)
+        manifest = os.path.join(self.tmp.name, 'batch.csv')
+        with open(manifest, 'w') as manifest_file:
+            manifest_file.write('csv,mapping\na.csv,mapping.py\nb.csv,other.py\n')
+
+        rejects = os.path.join(self.tmp.name, 'rejects.csv')
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            m2m.main(['--batch', manifest, '-w', '--continue-on-error', '--rejects', rejects])
+        self.assertEqual(os.listdir(self.output), ['id1'])
+        self.assertEqual(os.listdir(other_output), ['id3'])
+        self.assertIn('2 CSV files: 3 rows, 1 rejected\n', stdout.getvalue())
+        with open(os.path.join(self.tmp.name, 'rejects-b.csv'), newline='') as rejects_file:
+            self.assertEqual([row['isbn'] for row in csv.DictReader(rejects_file)], ['id2'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'rejects-a.csv')))
+
+    def test_batch_rejects_single_csv_options(self):
+        self.write_csv([], name='a.csv')
+        self.write_csv([], name='b.csv')
+
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--row', '1', csv_file=os.path.join(self.tmp.name, '*.csv'))
+        self.assertIn('only support one CSV file', str(cm.exception))
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main(csv_file=os.path.join(self.tmp.name, '*.tsv'))
+        self.assertEqual(str(cm.exception), 'No CSV files match %s'
+                         % os.path.join(self.tmp.name, '*.tsv'))
+
+    def test_convert_sqlite_query(self):
+        database = os.path.join(self.tmp.name, 'books.sqlite')
+        with contextlib.closing(sqlite3.connect(database)) as connection:
+            connection.execute('CREATE TABLE books (name TEXT, author TEXT, isbn TEXT)')
+            connection.execute("INSERT INTO books VALUES ('Title', 'Author', 'id1')")
+            connection.commit()
+
+        self.run_main('-w', '--query', 'SELECT name AS title, author, NULL AS date, isbn '
+                      'FROM books', csv_file=database)
+        with open(os.path.join(self.output, 'id1', 'metadata.xml')) as xml_file:
+            self.assertIn('>Title<', xml_file.read())
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--query', 'SELECT 1')
+        self.assertEqual(str(cm.exception), '--query requires SQLite input files.')
+
+    def test_folder_collision_policies(self):
+        csv_file = self.write_csv([['Title 1', 'Author', '', 'id1'],
+                                   ['Title 2', 'Author', '', 'id1'],
+                                   ['Title 3', 'Author', '', 'id1-2']])
+        folder = os.path.join(self.output, 'id1')
+
+        def title(foldername):
+            with open(os.path.join(self.output, foldername, 'metadata.xml')) as xml_file:
+                return re.search('>(Title .)<', xml_file.read()).group(1)
+
+        for jobs in ('1', '2'):
+            output = self.run_main('-w', '--jobs', jobs, '--on-collision', 'warn',
+                                   csv_file=csv_file)
+            self.assertIn('Row 1 has the same folder %s as row 0, overwriting it\n' % folder,
+                          output)
+            self.assertIn('1 rows had the same folder as an earlier row', output)
+            self.assertEqual(title('id1'), 'Title 2')
+
+            output = self.run_main('-w', '--jobs', jobs, '--on-collision', 'skip',
+                                   csv_file=csv_file)
+            self.assertIn('Row 1 has the same folder %s as row 0, skipping it\n' % folder,
+                          output)
+            self.assertEqual(title('id1'), 'Title 1')
+
+            shutil.rmtree(self.output)
+            self.run_main('-w', '--jobs', jobs, '--on-collision', 'suffix', csv_file=csv_file)
+            self.assertEqual([title(name) for name in ('id1', 'id1-2', 'id1-2-2')],
+                             ['Title 1', 'Title 2', 'Title 3'])
+
+            with self.assertRaises((SystemExit, m2m.MetadataConverterException)) as cm:
+                self.run_main('-w', '--jobs', jobs, '--on-collision', 'error',
+                              csv_file=csv_file)
+            self.assertIn('Row 1 has the same folder %s as row 0' % folder, str(cm.exception))
+            shutil.rmtree(self.output)
+
+    def test_skip_unchanged_reports_files_left_alone(self):
+        self.run_main('-w', '-j')
+        output = self.run_main('-w', '-j', '--skip-unchanged')
+        self.assertIn('2 files were already up to date', output)
+
+    def test_creation_date_is_shared_by_every_record(self):
+        with open(self.mapping, 'w') as mapping_file:
+            mapping_file.write(MAPPING_TEMPLATE.replace("RecordClass('mphillips')",
+                                                        "RecordClass('mphillips', addDate=True)")
+                               % self.output)
+        csv_file = self.write_csv([['Title %s' % n, 'Author', '', 'id%s' % n] for n in range(4)])
+
+        for jobs in ('1', '2'):
+            self.run_main('-w', '--jobs', jobs, '--creation-date', '2020-01-31, 09:30:00',
+                          csv_file=csv_file)
+            for n in range(4):
+                with open(os.path.join(self.output, 'id%s' % n, 'metadata.xml')) as xml_file:
+                    self.assertIn('>2020-01-31, 09:30:00<', xml_file.read())
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main('--creation-date', 'yesterday', csv_file=csv_file)
+        self.assertIn('--creation-date must look like', str(cm.exception))
+
+    def test_cached_mapping_is_compiled_again_when_changed(self):
+        first = m2m.cachedMappingFunction(self.mapping)
+        self.assertIs(m2m.cachedMappingFunction(self.mapping), first)
+
+        with open(self.mapping, 'a') as mapping_file:
+            mapping_file.write('\n# changed\n')
+        self.assertIsNot(m2m.cachedMappingFunction(self.mapping), first)
+
+
 def suite():
     all_tests = unittest.TestSuite()
     all_tests.addTest(unittest.makeSuite(CSVToDictTests))
     all_tests.addTest(unittest.makeSuite(MetadataRecordTests))
+    all_tests.addTest(unittest.makeSuite(MappingPlanTests))
+    all_tests.addTest(unittest.makeSuite(ValidateRowsTests))
+    all_tests.addTest(unittest.makeSuite(ColumnarPreprocessorTests))
+    all_tests.addTest(unittest.makeSuite(NodeCacheTests))
+    all_tests.addTest(unittest.makeSuite(MemoizeTests))
+    all_tests.addTest(unittest.makeSuite(SerializeUNTLTests))
+    all_tests.addTest(unittest.makeSuite(CompactRecordTests))
+    all_tests.addTest(unittest.makeSuite(OutputWriterTests))
+    all_tests.addTest(unittest.makeSuite(PipelineTests))
+    all_tests.addTest(unittest.makeSuite(ArchiveWriterTests))
+    all_tests.addTest(unittest.makeSuite(ProgressReporterTests))
+    all_tests.addTest(unittest.makeSuite(BenchmarkTests))
+    all_tests.addTest(unittest.makeSuite(CommandLineTests))
 
     return all_tests
 